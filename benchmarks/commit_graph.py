@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the commit-graph reachability queries against pygit2.
+
+Builds a synthetic repository shaped like the Sage history (a development
+branch into which short ticket branches, forked from recent development
+commits, are merged), writes its commit-graph, and times
+`Reachability.is_ancestor` against ``Repository.merge_base`` and
+`Reachability.difference` against a pygit2 walker with hidden commits, which
+is what `GitBase` falls back to without a commit-graph.  The results of both
+are compared for every query.
+
+Usage::
+
+    python benchmarks/commit_graph.py [--commits 100000] [--queries 200]
+                                      [--repo PATH] [--seed N]
+
+If ``--repo`` names an existing repository it is reused rather than rebuilt.
+"""
+
+from __future__ import print_function
+
+import argparse
+import itertools
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import pygit2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from sage_trac.commit_graph import CommitGraph, Reachability
+
+
+def build_repository(path, num_commits, rng):
+    """
+    Create a bare repository at ``path`` with about ``num_commits`` commits
+    using git fast-import, whose marks (in commit order) are exported to
+    its ``marks`` file.
+    """
+
+    subprocess.check_call(['git', 'init', '--quiet', '--bare', path])
+    proc = subprocess.Popen(['git', 'fast-import', '--quiet',
+                             '--export-marks=marks'], cwd=path,
+                            stdin=subprocess.PIPE)
+
+    marks = itertools.count(1)
+    timestamp = [1400000000]
+    develop = []
+
+    def commit(ref, message, parent=None, merge=None):
+        mark = next(marks)
+        timestamp[0] += 60
+        lines = [
+            'commit %s' % ref,
+            'mark :%d' % mark,
+            'committer Bench <bench@example.org> %d +0000' % timestamp[0],
+            'data %d' % len(message),
+            message
+        ]
+        if parent is not None:
+            lines.append('from :%d' % parent)
+        if merge is not None:
+            lines.append('merge :%d' % merge)
+        content = '%d\n' % mark
+        lines.extend(['M 644 inline file', 'data %d' % len(content),
+                      content])
+        proc.stdin.write(('\n'.join(lines) + '\n').encode('ascii'))
+        return mark
+
+    count = 0
+    while count < num_commits:
+        if len(develop) < 10 or rng.random() < 0.3:
+            parent = develop[-1] if develop else None
+            develop.append(commit('refs/heads/develop', 'develop', parent))
+            count += 1
+            continue
+
+        # A ticket branch forked from a recent development commit
+        tip = develop[-rng.randint(1, min(len(develop), 500))]
+        for _ in range(rng.randint(1, 20)):
+            tip = commit('refs/heads/ticket', 'ticket', tip)
+            count += 1
+        develop.append(commit('refs/heads/develop', 'merge', develop[-1],
+                              merge=tip))
+        count += 1
+
+    proc.stdin.close()
+    if proc.wait() != 0:
+        raise RuntimeError('git fast-import failed')
+
+
+def read_marks(path):
+    marks = {}
+    with open(os.path.join(path, 'marks')) as f:
+        for line in f:
+            mark, hex = line.split()
+            marks[int(mark[1:])] = hex
+    return marks
+
+
+def time_queries(func, queries):
+    start = time.time()
+    results = [func(*query) for query in queries]
+    return time.time() - start, results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--commits', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--repo', help='repository to build or reuse')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    tmpdir = None
+    path = args.repo
+    if path is None:
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'repo.git')
+
+    try:
+        if not os.path.exists(os.path.join(path, 'marks')):
+            start = time.time()
+            build_repository(path, args.commits, rng)
+            print('Built %s in %.1fs' % (path, time.time() - start))
+            subprocess.check_call(['git', 'commit-graph', 'write',
+                                   '--reachable'], cwd=path)
+
+        marks = read_marks(path)
+        hexes = [marks[m] for m in sorted(marks)]
+        print('%d commits' % len(hexes))
+
+        repo = pygit2.Repository(path)
+        graph = CommitGraph(os.path.join(path, 'objects', 'info',
+                                         'commit-graph'))
+
+        # Pairs of commits close enough in history for either answer to be
+        # likely, and pairs of newer commits against old ones
+        ancestor_queries = []
+        for _ in range(args.queries):
+            i = rng.randrange(len(hexes))
+            j = min(len(hexes) - 1, i + rng.randint(0, 2000))
+            ancestor_queries.append((hexes[i], hexes[j]))
+            ancestor_queries.append((hexes[rng.randrange(len(hexes) // 10)],
+                                     hexes[-rng.randint(1, 100)]))
+
+        # A branch tip against a newer commit (commits on the branch not yet
+        # merged), and the head against an older commit (a log page)
+        difference_queries = []
+        for _ in range(args.queries):
+            i = rng.randrange(len(hexes))
+            j = min(len(hexes) - 1, i + rng.randint(0, 2000))
+            difference_queries.append((hexes[i], hexes[max(0, j - 100)],
+                                       None))
+            difference_queries.append((hexes[-1], hexes[-rng.randint(1, 5000)],
+                                       50))
+
+        def graph_is_ancestor(a, b):
+            return Reachability(graph, repo).is_ancestor(a, b)
+
+        def merge_base_is_ancestor(a, b):
+            a = pygit2.Oid(hex=a)
+            return repo.merge_base(a, pygit2.Oid(hex=b)) == a
+
+        def graph_difference(tip, hidden, limit):
+            return Reachability(graph, repo).difference([tip], [hidden],
+                                                        limit)
+
+        def walker_difference(tip, hidden, limit):
+            walker = repo.walk(pygit2.Oid(hex=tip),
+                    pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_TIME)
+            walker.hide(pygit2.Oid(hex=hidden))
+            return [str(c.id) for c in itertools.islice(walker, limit)]
+
+        failures = 0
+        for name, queries, new, old in [
+                ('is_ancestor', ancestor_queries, graph_is_ancestor,
+                 merge_base_is_ancestor),
+                ('difference', difference_queries, graph_difference,
+                 walker_difference)]:
+            new_time, new_results = time_queries(new, queries)
+            old_time, old_results = time_queries(old, queries)
+
+            for query, a, b in zip(queries, new_results, old_results):
+                # Without a limit only the commits, not their order, are
+                # guaranteed to agree: ties in commit time may be ordered
+                # differently
+                if isinstance(a, list) and query[2] is None:
+                    a, b = set(a), set(b)
+                elif isinstance(a, list):
+                    a, b = len(a), len(b)
+                if a != b:
+                    failures += 1
+                    print('MISMATCH %s%r: %r != %r' % (name, query, a, b))
+
+            print('%-12s %4d queries: commit-graph %.3fs, pygit2 %.3fs '
+                  '(%.1fx)' % (name, len(queries), new_time, old_time,
+                               old_time / max(new_time, 1e-9)))
+
+        return 1 if failures else 0
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Long-lived Perspective Broker client for submitting changes to a buildbot
+master's PB change source.
+"""
+
+import collections
+import os
+import threading
+
+from twisted.cred import credentials
+from twisted.internet import protocol
+from twisted.internet.selectreactor import SelectReactor
+from twisted.spread import pb
+
+
+_reactor_lock = threading.Lock()
+_reactor = None
+_reactor_pid = None
+
+
+def _get_reactor():
+    """
+    Return the Twisted reactor running in a daemon thread of this process,
+    starting it first if needed.
+
+    A reactor can only be run once, and a forked process inherits its
+    parent's reactor (and its file descriptors) but not the thread running
+    it, so rather than the global reactor each process runs its own, which
+    is never stopped.
+    """
+
+    global _reactor, _reactor_pid
+
+    with _reactor_lock:
+        if _reactor is not None and _reactor_pid == os.getpid():
+            return _reactor
+
+        _reactor = SelectReactor()
+        _reactor_pid = os.getpid()
+        thread = threading.Thread(
+                target=_reactor.run, name='buildbot-reactor',
+                kwargs={'installSignalHandlers': False})
+        thread.daemon = True
+        thread.start()
+        return _reactor
+
+
+class ChangeResult(object):
+    """
+    The outcome of a change submitted with `BuildbotClient.add_change`.
+    """
+
+    def __init__(self, callback=None):
+        self._done = threading.Event()
+        self.callback = callback
+        self.success = None
+        self.error = None
+
+    def wait(self, timeout=None):
+        """
+        Wait up to ``timeout`` seconds for the change to be accepted or
+        rejected, and return True if it was accepted.
+        """
+
+        self._done.wait(timeout)
+        return bool(self.success)
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def _set(self, success, error=None):
+        self.success = success
+        self.error = error
+        self._done.set()
+
+
+class _ChangeSourceFactory(pb.PBClientFactory,
+                           protocol.ReconnectingClientFactory):
+    """
+    PB client factory that logs in again whenever it connects, and
+    reconnects with exponential backoff (up to ``maxDelay`` seconds) when
+    the connection is lost or cannot be made, or logging in fails.
+    """
+
+    maxDelay = 60
+
+    def __init__(self, client):
+        pb.PBClientFactory.__init__(self)
+        self.client = client
+
+    def clientConnectionMade(self, broker):
+        pb.PBClientFactory.clientConnectionMade(self, broker)
+        self.login(self.client.credentials).addCallbacks(
+                self._logged_in, self._login_failed)
+
+    def _logged_in(self, remote):
+        # Only back off from the master while it does not let us in
+        self.resetDelay()
+        self.client._connected(remote)
+
+    def _login_failed(self, failure):
+        self.client._login_failed(failure)
+        # Reconnect (and log in again) after the backoff delay
+        self.disconnect()
+
+    def clientConnectionFailed(self, connector, reason):
+        pb.PBClientFactory.clientConnectionFailed(self, connector, reason)
+        self.client._disconnected(reason)
+        protocol.ReconnectingClientFactory.clientConnectionFailed(
+                self, connector, reason)
+
+    def clientConnectionLost(self, connector, reason):
+        pb.PBClientFactory.clientConnectionLost(self, connector, reason)
+        self.client._disconnected(reason)
+        protocol.ReconnectingClientFactory.clientConnectionLost(
+                self, connector, reason)
+
+
+class BuildbotClient(object):
+    """
+    Keeps one authenticated PB connection to a buildbot master, over which
+    changes are sent as they are submitted, without waiting for earlier
+    changes to be acknowledged.
+
+    The connection is made by the reactor running in a background thread
+    (see `_get_reactor`), on first use.  Changes submitted while not
+    connected are queued (up to ``max_queued``, dropping the oldest) and
+    sent once the connection is (re)established, or failed if logging in
+    fails.
+
+    Use `get` to get the client shared by all Components of the process.
+    """
+
+    max_queued = 1000
+
+    _clients = {}
+    _clients_pid = None
+    _clients_lock = threading.Lock()
+
+    def __init__(self, host, port, username, password, log=None):
+        self.host = host
+        self.port = port
+        self.credentials = credentials.UsernamePassword(username, password)
+        self.log = log
+        self._remote = None
+        # Only touched from the reactor thread
+        self._queue = collections.deque()
+        self._reactor = _get_reactor()
+        self._factory = _ChangeSourceFactory(self)
+        self._factory.clock = self._reactor
+
+    @classmethod
+    def get(cls, host, port, username, password, log=None):
+        key = (host, port, username, password)
+        with cls._clients_lock:
+            # Clients inherited from the parent of a forked process belong
+            # to its reactor, which does not run in this process
+            if cls._clients_pid != os.getpid():
+                cls._clients = {}
+                cls._clients_pid = os.getpid()
+
+            client = cls._clients.get(key)
+            if client is None:
+                client = cls._clients[key] = cls(host, port, username,
+                                                 password, log=log)
+                client._connect()
+            return client
+
+    def _connect(self):
+        """Start connecting to the buildbot master, from any thread."""
+
+        self._reactor.callFromThread(self._reactor.connectTCP, self.host,
+                                     self.port, self._factory)
+
+    @property
+    def connected(self):
+        return self._remote is not None
+
+    def add_change(self, change, callback=None):
+        """
+        Submit a change (a dict as expected by buildbot's ``addChange``)
+        from any thread, and return a `ChangeResult`.
+
+        If given, ``callback`` is called without arguments (in the reactor
+        thread) once the change has been accepted, even if nobody is
+        waiting on the result anymore.
+        """
+
+        result = ChangeResult(callback)
+        self._reactor.callFromThread(self._submit, change, result)
+        return result
+
+    # The methods below run in the reactor thread
+
+    def _submit(self, change, result):
+        if self._remote is None:
+            if len(self._queue) >= self.max_queued:
+                _, dropped = self._queue.popleft()
+                dropped._set(False, 'too many changes queued')
+            self._queue.append((change, result))
+            return
+
+        try:
+            deferred = self._remote.callRemote('addChange', change)
+        except pb.DeadReferenceError as exc:
+            self._queue.append((change, result))
+            self._disconnected(exc)
+            return
+
+        deferred.addCallbacks(lambda _: self._change_accepted(result),
+                              lambda failure: self._change_failed(
+                                  result, failure))
+
+    def _change_accepted(self, result):
+        try:
+            if result.callback is not None:
+                result.callback()
+        except Exception as exc:
+            self._log('error', 'error handling change accepted by buildbot '
+                      'at %s: %s', self.host, exc)
+        finally:
+            result._set(True)
+
+    def _change_failed(self, result, failure):
+        self._log('error', 'buildbot at %s rejected change: %s', self.host,
+                  failure.getErrorMessage())
+        result._set(False, failure.getErrorMessage())
+
+    def _connected(self, remote):
+        self._log('debug', 'successfully connected to %s', self.host)
+        self._remote = remote
+        queued, self._queue = self._queue, collections.deque()
+        for change, result in queued:
+            self._submit(change, result)
+
+    def _login_failed(self, failure):
+        error = failure.getErrorMessage()
+        self._log('error', 'logging in to buildbot at %s failed: %s',
+                  self.host, error)
+        # The changes waiting for this connection are failed rather than
+        # left to wait for a login that may never succeed
+        queued, self._queue = self._queue, collections.deque()
+        for _, result in queued:
+            result._set(False, 'logging in to buildbot failed: %s' % error)
+
+    def _disconnected(self, reason):
+        if self._remote is not None:
+            self._log('warning', 'connection to buildbot at %s lost: %s',
+                      self.host, reason)
+        self._remote = None
+
+    def _log(self, level, msg, *args):
+        if self.log is not None:
+            getattr(self.log, level)(msg, *args)
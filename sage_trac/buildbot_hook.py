@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 
-from trac.core import implements, TracError, tracid
+from trac.core import implements, TracError
+from trac.db.schema import Table, Column, Index
 from trac.ticket.api import ITicketManipulator
 from trac.ticket.model import Ticket
-from trac.web.api import ITemplateStreamFilter
+from trac.web.api import ITemplateStreamFilter, RequestDone
+from trac.web.chrome import add_script
 from tracrpc.api import IXMLRPCHandler
 
 from .common import hexify
@@ -13,26 +15,56 @@ from . import git_merger
 from genshi.builder import tag
 from genshi.filters import Transformer
 
-from twisted.cred import credentials
-from twisted.internet import reactor
-from twisted.spread import pb
+from .buildbot_client import BuildbotClient
 
-import multiprocessing
+import email.utils
+import hashlib
+import json
+import pkg_resources
 import re
+import threading
+import time
 import urlparse
 
-GIT_DIFF_REGEX = re.compile(r'^diff --git a/(.*) b/(.*)$', re.MULTILINE)
-
 FILTER = Transformer('//table[@class="properties"]')
 
 RESULTS = ("Success", "Warnings", "Failure", "Skipped", "Exception", "Retry")
 
+_MERGE_RESULTS = {
+    git_merger.GIT_FASTFORWARD: 'fastforward',
+    git_merger.GIT_UPTODATE: 'uptodate',
+    git_merger.GIT_FAILED_MERGE: 'failed'
+}
+
 
 class BuildbotHook(git_merger.GitMerger):
     implements(ITicketManipulator)
     implements(IXMLRPCHandler)
     implements(ITemplateStreamFilter)
 
+    # Replaces (rather than extends) the schema of GitMerger; its tables are
+    # managed by GitMerger itself
+    _schema = [
+        Table('build_store', key=('target', 'base'))[
+            Column('base'),
+            Column('target'),
+            Column('builder'),
+            Column('number', type='int'),
+            Column('status', type='int'),
+            Column('tracid', type='int'),
+            Column('time', type='int'),
+            Index(['tracid'])
+        ]
+    ]
+
+    _schema_version = 2
+
+    # Changes submitted for builds requested by the status endpoint, by
+    # commit, so that polls do not submit the same change again while the
+    # buildmaster has yet to accept it
+    _pending_changes = {}
+    _pending_changes_lock = threading.Lock()
+
     def __init__(self):
         super(BuildbotHook, self).__init__()
 
@@ -49,65 +81,93 @@ class BuildbotHook(git_merger.GitMerger):
                 self.port = 9989
 
         self.port = int(self.config.get("buildbot", "port", self.port))
+        # Seconds to wait for the buildmaster to accept a change before
+        # giving up waiting (the change is still sent)
+        self.timeout = int(self.config.get("buildbot", "timeout", 5))
         self.prefix = self.config.get("buildbot", "prefix", "")
         if self.prefix and self.prefix[-1] != "/":
             self.prefix += "/"
+        # Seconds between polls of the status endpoint by ticket pages while
+        # a build or merge is pending
+        self.poll_interval = int(self.config.get("buildbot", "poll_interval",
+                                                 30))
 
     def get_changed_files(self, ancestor, descendant):
         if ancestor.oid == descendant.oid:
             return None
-        matches = GIT_DIFF_REGEX.finditer(
-                self._git.diff(ancestor, descendant).patch)
-        return {file for match in matches for file in match.groups()}
-
-    def _get_cache(self, commitortracid):
-        BuildbotHook._create_table(self)
+        return set(self.changed_paths(ancestor, descendant))
+
+    def _upgrade_schema(self, db, prev_version):
+        # Earlier versions created a build_store table keyed on target alone
+        # on the fly, and dropped it whenever the master branch moved;
+        # version 2 added the time each row was last set
+        if prev_version is False or prev_version < 2:
+            rows = db("""
+                SELECT base, target, builder, number, status, tracid
+                FROM build_store""")
+            db('DROP TABLE "build_store"')
+            self._create_tables(db, ['build_store'])
+            now = int(time.time())
+            for row in rows:
+                db("""
+                    INSERT INTO build_store
+                        (base, target, builder, number, status, tracid, time)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+                   tuple(row) + (now,))
+
+    def _get_build_cache(self, commitortracid):
+        """
+        Return the builder, build number, and status of the build of the
+        given commit (or of the latest build for the given ticket ID) on
+        the current master branch, if any.
+
+        Builds for earlier tips of the master branch are kept, but ignored.
+        """
+
+        master = self.master
         commit = hexify(commitortracid)
-        if isinstance(commit, basestring):
-            statement = ('SELECT base, builder, number, status FROM "build_store" WHERE target=%s', (commit,))
-        else:
-            statement = ('SELECT base, builder, number, status FROM "build_store" WHERE tracid=%s', (tracid,))
-        with self.env.db_query as db:
-            cursor = db.cursor()
-            cursor.execute(*statement)
-            try:
-                base, builder, number, status = cursor.next()
-            except StopIteration:
-                if self.master.hex != commit:
-                    self._real_get_build(self.master_branch)
-                return None
-        if base != self.master.hex:
-            BuildbotHook._drop_table(self)
-            self._real_get_build(self.master_branch)
-            return None
-        return builder, number, status
+        row = self._query_build(commit, master)
+        if row is not None:
+            return row[:3]
 
-    def _set_cache(self, commit, builder=None, number=None, status=None, tracid=None):
-        BuildbotHook._create_table(self)
-        commit = hexify(commit)
-        with self.env.db_transaction as db:
-            cursor = db.cursor()
-            cursor.execute('DELETE FROM "build_store" WHERE target=%s', (commit,))
-            cursor.execute('INSERT INTO "build_store" VALUES (%s, %s, %s, %s, %s, %s)', (self.master.hex, commit, builder, number, status, tracid))
+        if master.hex != commit:
+            # Make sure the master branch itself is built first
+            self._real_get_build(self.master_branch)
+        return None
 
-    def _create_table(self):
-        with self.env.db_transaction as db:
-            cursor = db.cursor()
-            cursor.execute('SELECT * FROM information_schema.tables WHERE "table_name"=%s', ('build_store',))
-            try:
-                cursor.next()
-            except StopIteration:
-                cursor.execute('CREATE TABLE "build_store" ( base text, target text, builder text, number int, status int, tracid int, PRIMARY KEY ( target ), UNIQUE ( target ) )')
+    def _query_build(self, commitortracid, master):
+        """
+        Return the builder, build number, status, and time last set of the
+        build of the given commit (or the latest build for the given ticket
+        ID) on the given tip of the master branch, or `None`.
+        """
 
-    def _drop_table(self):
+        if isinstance(commitortracid, basestring):
+            column = 'target'
+        else:
+            column = 'tracid'
+
+        for row in self.env.db_query("""
+                SELECT builder, number, status, time FROM build_store
+                WHERE %s=%%s AND base=%%s
+                ORDER BY time DESC""" % column,
+                (commitortracid, master.hex)):
+            return tuple(row)
+        return None
+
+    def _set_build_cache(self, commit, builder=None, number=None, status=None,
+                         tracid=None):
+        commit = hexify(commit)
+        base = self.master.hex
         with self.env.db_transaction as db:
-            cursor = db.cursor()
-            cursor.execute('SELECT * FROM information_schema.tables WHERE "table_name"=%s', ('build_store',))
-            try:
-                cursor.next()
-                cursor.execute('DROP TABLE "build_store"')
-            except StopIteration:
-                pass
+            db("DELETE FROM build_store WHERE target=%s AND base=%s",
+               (commit, base))
+            db("""
+                INSERT INTO build_store
+                    (base, target, builder, number, status, tracid, time)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+               (base, commit, builder, number, status, tracid,
+                int(time.time())))
 
     def _real_get_build(self, branch, author='', tracid=None):
         try:
@@ -117,7 +177,7 @@ class BuildbotHook(git_merger.GitMerger):
         except AttributeError:
             commit = branch
 
-        res = BuildbotHook._get_cache(self, commit)
+        res = self._get_build_cache(commit)
         if res is not None:
             return res
 
@@ -132,6 +192,18 @@ class BuildbotHook(git_merger.GitMerger):
             elif merge == git_merger.GIT_FASTFORWARD:
                 merge = commit
 
+        result = self._submit_change(branch, commit, merge, author, tracid)
+        if not result.wait(self.timeout):
+            return None
+        return self._real_get_build(branch, author, tracid)
+
+    def _submit_change(self, branch, commit, merge, author='', tracid=None):
+        """
+        Send the change for building ``merge`` (the merge of ``commit``
+        into the master branch) to the buildmaster, without waiting, and
+        return its `ChangeResult`.
+        """
+
         change = {'repository': self.repository,
                   'who': author,
                   'files': self.get_changed_files(self.master, merge),
@@ -145,53 +217,21 @@ class BuildbotHook(git_merger.GitMerger):
             change['comments'] = \
                     u'From Trac #{tracid} ({base}/{tracid})'.format(
                             base=self.env.base_url, tracid=unicode(tracid))
-            change['properties']['trac_ticket'] = tracid
+            change['properties'] = {'trac_ticket': tracid}
 
         for key in change:
             if isinstance(change[key], str):
                 change[key] = unicode(change[key])
 
-        queue = multiprocessing.Queue()
-
-        def call_addChange(remote):
-            self.log.debug('sucessfully connected to {}'.format(self.host))
-            deferred = remote.callRemote('addChange', change)
-            deferred.addCallbacks(
-                    lambda res: queue.put(True),
-                    lambda res: queue.put(False))
-            deferred.addBoth(lambda res: remote.broker.transport.loseConnection())
-            return deferred
-
-        def connectFailed(error):
-            self.log.error('connecting to {} failed'.format(self.host))
-            queue.put(False)
-            return error
-
-        def cleanup(res):
-            reactor.stop()
-            return res
-
-        def run_reactor():
-            factory = pb.PBClientFactory()
-            deferred = factory.login(
-                    credentials.UsernamePassword(self.username, self.password))
-
-            reactor.connectTCP(self.host, self.port, factory)
-
-            deferred.addCallbacks(call_addChange, connectFailed)
-            deferred.addBoth(cleanup)
-
-            reactor.run()
-
-        # since twisted's reactor can only be run once,
-        # do it in another process
-        multiprocessing.Process(target=run_reactor).start()
-
-        if queue.get():
-            BuildbotHook._set_cache(self, commit, tracid=tracid)
-        else:
-            return None
-        return self._real_get_build(branch, author, tracid)
+        # The change is sent over a connection to the buildmaster kept open
+        # by a reactor thread shared by the whole process; the build is
+        # cached once the buildmaster accepts the change, even if that
+        # takes longer than we are willing to wait here
+        client = BuildbotClient.get(self.host, self.port, self.username,
+                                    self.password, log=self.log)
+        return client.add_change(
+                change,
+                lambda: self._set_build_cache(commit, tracid=tracid))
 
     def _get_build(self, req, ticket, extra_checks):
         def get_build():
@@ -202,7 +242,7 @@ class BuildbotHook(git_merger.GitMerger):
                 if req.args.get('id') is None:
                     return
                 if ticket['status'] == 'needs_work':
-                    return self._get_cache(req.args.get('id'))
+                    return self._get_build_cache(int(req.args.get('id')))
                 if ticket['status'] not in ('needs_review', 'positive_review'):
                     return
 
@@ -224,28 +264,110 @@ class BuildbotHook(git_merger.GitMerger):
     def set_build(self, req, sha, builder=None, number=None, status=None, tracid=None):
         if req.authname != 'git':
             raise TracError("only buildbot has permissions to set builds")
-        BuildbotHook._set_cache(self, sha, builder, number, status, tracid)
-
-    # ITemplateStreamFilter methods
-    def filter_stream(self, req, method, filename, stream, data):
-        ticket = data.get('ticket')
-        if filename != 'ticket.html' or ticket is None:
-            return stream
-
-        build = self._get_build(req, ticket, True)
+        self._set_build_cache(sha, builder, number, status, tracid)
+
+    def get_status(self, req, ticket):
+        """
+        Return the build and merge status of the ticket's branch as served
+        by the status endpoint, along with its ETag and last modification
+        time (or `None`).
+
+        Only cached builds and merges are reported, and merges only for
+        branches in review.  A merge that is not cached yet is queued for the
+        merge workers (never computed here), and once it is cached a build
+        of the merge is requested from the buildmaster, without waiting for
+        it.
+        """
+
+        master = self.master
+        status = ticket['status']
+        in_review = status in ('needs_review', 'positive_review')
+        commit = merge = build = None
+
+        branch = (ticket['branch'] or '').strip()
+        if branch:
+            try:
+                commit = self.generic_lookup(branch)[1]
+            except (KeyError, ValueError):
+                commit = None
+
+        if status == 'needs_work':
+            build = self._query_build(ticket.id, master)
+        elif in_review and commit is not None:
+            build = self._query_build(commit.hex, master)
+
+        if in_review and commit is not None:
+            if commit.oid == master.oid:
+                merge = git_merger.GIT_UPTODATE
+            else:
+                merge = self.peek_merge(commit)
+                if merge is None:
+                    self.queue_merge(
+                            commit,
+                            priority=git_merger.MERGE_PRIORITY_INTERACTIVE)
+
+            if merge not in (None,) + git_merger.GIT_SPECIAL_MERGES:
+                merge = merge.hex
+
+        # Whether the status is expected to change without the branch or
+        # master branch moving
+        pending = build is not None and build[2] in (None, -1)
+        if in_review and commit is not None:
+            buildable = merge not in (git_merger.GIT_UPTODATE,
+                                      git_merger.GIT_FAILED_MERGE)
+            if merge is None:
+                pending = True
+            elif build is None and buildable:
+                self._request_build(branch, commit, merge, req.authname,
+                                    ticket.id)
+                pending = True
+
+        data = {
+            'ticket': ticket.id,
+            'commit': hexify(commit),
+            'base': master.hex,
+            'merge': None,
+            'build': None,
+            'poll': self.poll_interval if pending else 0
+        }
+
+        if in_review and commit is not None:
+            data['merge'] = {
+                'result': _MERGE_RESULTS.get(merge, merge and 'merged'),
+                'url': req.href('git-merger', commit.hex)
+            }
+
+        if build is not None:
+            data['build'] = self._build_status(*build[:3])
+
+        etag = '"%s"' % hashlib.sha1(repr((
+                ticket.id, status, data['commit'], master.hex, merge,
+                build)).encode('utf-8')).hexdigest()
+        last_modified = build[3] if build is not None else None
+
+        return data, etag, last_modified
+
+    def _request_build(self, branch, commit, merge, author, tracid):
+        if merge == git_merger.GIT_FASTFORWARD:
+            merge = commit
+        else:
+            merge = self._git[merge]
 
-        if not build:
-            return stream
+        with self._pending_changes_lock:
+            pending = self._pending_changes.get(commit.hex)
+            if pending is not None and not pending.done:
+                return
 
-        builder, number, rc = build
+            for key, result in list(self._pending_changes.items()):
+                if result.done:
+                    del self._pending_changes[key]
 
-        def buildbot_status(status):
-            content = tag.h2("Buildbot: ")
-            content.append(status)
-            return FILTER.append(tag.div(content, class_="buildbot"))
+            self._pending_changes[commit.hex] = self._submit_change(
+                    branch, commit, merge, author, tracid)
 
+    def _build_status(self, builder, number, rc):
         if rc is None:
-            return stream | buildbot_status("Queued")
+            return {'result': 'Queued', 'class': None, 'url': None}
 
         if rc == -1:
             result = 'In progress'
@@ -257,20 +379,98 @@ class BuildbotHook(git_merger.GitMerger):
             else:
                 color_class = 'positive_review'
 
-        return stream | buildbot_status(
-                tag.a(
-                    result,
-                    class_=color_class,
-                    href=urlparse.urlunsplit((
-                        'http',
-                        self.host,
-                        '{prefix}builders/{builder}/builds/{number}'.format(
-                            prefix=self.prefix,
-                            builder=builder,
-                            number=number),
-                        '',
-                        ''))
-                ))
+        url = urlparse.urlunsplit((
+            'http',
+            self.host,
+            '{prefix}builders/{builder}/builds/{number}'.format(
+                prefix=self.prefix,
+                builder=builder,
+                number=number),
+            '',
+            ''))
+
+        return {'result': result, 'class': color_class, 'url': url}
+
+    # ITemplateStreamFilter methods
+    def filter_stream(self, req, method, filename, stream, data):
+        ticket = data.get('ticket')
+        if (filename != 'ticket.html' or ticket is None or
+                not ticket.exists or req.args.get('preview') is not None):
+            return stream
+
+        if not (ticket['branch'] or ticket['status'] == 'needs_work'):
+            return stream
+
+        # Only a placeholder is rendered here; it is filled in by
+        # sage-status.js from the status endpoint, so that rendering the
+        # ticket never waits on git or the buildmaster
+        add_script(req, 'sage_trac/sage-status.js')
+        placeholder = tag.div(
+                tag.h2("Buildbot: ", tag.span(class_="buildbot-result")),
+                tag.h2("Merge: ", tag.span(class_="merge-result")),
+                class_="buildbot", id="buildbot-status",
+                style="display: none",
+                **{'data-url': req.href('buildbot', 'status', ticket.id)})
+
+        return stream | FILTER.append(placeholder)
+
+    # IRequestHandler methods
+    def match_request(self, req):
+        match = re.match(r'/buildbot/status/(\d+)$', req.path_info)
+        if match:
+            req.args['id'] = match.group(1)
+            return True
+        return super(BuildbotHook, self).match_request(req)
+
+    def process_request(self, req):
+        if not req.path_info.startswith('/buildbot/status/'):
+            return super(BuildbotHook, self).process_request(req)
+
+        ticket = Ticket(self.env, int(req.args['id']))
+        req.perm(ticket.resource).require('TICKET_VIEW')
+        data, etag, last_modified = self.get_status(req, ticket)
+
+        # The modification time is that of the build_store row, which is
+        # newer for any later build of the branch or of a new tip of the
+        # branch or master branch; without a row there is nothing to date
+        # the status by, so If-Modified-Since is not honored
+        if_none_match = req.get_header('If-None-Match')
+        if_modified_since = email.utils.parsedate_tz(
+                req.get_header('If-Modified-Since') or '')
+        if if_none_match is not None:
+            not_modified = etag in [t.strip()
+                                    for t in if_none_match.split(',')]
+        elif if_modified_since is not None and last_modified is not None:
+            not_modified = (last_modified <=
+                            email.utils.mktime_tz(if_modified_since))
+        else:
+            not_modified = False
+
+        if not_modified:
+            content = ''
+            req.send_response(304)
+        else:
+            content = json.dumps(data)
+            req.send_response(200)
+            req.send_header('Content-Type', 'application/json')
+
+        req.send_header('ETag', etag)
+        if last_modified is not None:
+            req.send_header('Last-Modified',
+                            email.utils.formatdate(last_modified,
+                                                   usegmt=True))
+        # Let browsers cache the status, but always revalidate it
+        req.send_header('Cache-Control', 'private, no-cache')
+        req.send_header('Content-Length', len(content))
+        req.end_headers()
+        if content:
+            req.write(content)
+        raise RequestDone
+
+    # ITemplateProvider methods
+    def get_htdocs_dirs(self):
+        return [('sage_trac',
+                 pkg_resources.resource_filename('sage_trac', 'htdocs'))]
 
     # ITicketManipulator methods
     def validate_ticket(self, req, ticket):
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+Reachability queries answered from git's commit-graph file.
+
+The commit-graph file (``objects/info/commit-graph``, written by ``git
+commit-graph write`` or ``git gc``) stores the parents and generation number
+of every commit reachable when it was written, so walks over history can be
+done without loading commits from the object database, and can stop as soon
+as generation numbers show that nothing further down can matter.
+
+See ``Documentation/technical/commit-graph-format.txt`` in git for the file
+format.  Only single-file (non-split) SHA-1 commit-graphs are read; commits
+added since the file was written are read through pygit2.
+"""
+
+import binascii
+import heapq
+import mmap
+import os
+import stat
+import struct
+import threading
+
+
+_SIGNATURE = b'CGPH'
+_HASH_LEN = 20
+_CDAT_WIDTH = _HASH_LEN + 16
+_PARENT_NONE = 0x70000000
+_EXTRA_EDGES = 0x80000000
+_EDGE_MASK = 0x7fffffff
+
+
+class CommitGraphError(Exception):
+    pass
+
+
+class CommitGraph(object):
+    """
+    A parsed commit-graph file.
+
+    Commits are identified by their position in the file; use `lookup` to
+    find the position of a commit from its binary SHA-1.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._data = data = mmap.mmap(f.fileno(), 0,
+                                          access=mmap.ACCESS_READ)
+
+        if len(data) < 8:
+            raise CommitGraphError('%s is truncated' % path)
+
+        signature, version, hash_version, num_chunks, num_bases = \
+                struct.unpack_from('>4sBBBB', data, 0)
+
+        if signature != _SIGNATURE:
+            raise CommitGraphError('%s is not a commit-graph file' % path)
+
+        if version != 1 or hash_version != 1 or num_bases:
+            raise CommitGraphError(
+                'unsupported commit-graph version %d (hash version %d, %d '
+                'base graphs) in %s' % (version, hash_version, num_bases,
+                                        path))
+
+        # Maps chunk IDs to their offsets; the table of contents ends with
+        # a terminating entry with a zero ID
+        chunks = {}
+        for idx in range(num_chunks):
+            chunk_id, offset = struct.unpack_from('>4sQ', data, 8 + 12 * idx)
+            chunks[chunk_id] = offset
+
+        for chunk_id in (b'OIDF', b'OIDL', b'CDAT'):
+            if chunk_id not in chunks:
+                raise CommitGraphError('%s has no %s chunk' %
+                                       (path, chunk_id.decode('ascii')))
+
+        self._fanout = struct.unpack_from('>256I', data, chunks[b'OIDF'])
+        self._oids = chunks[b'OIDL']
+        self._cdat = chunks[b'CDAT']
+        self._edges = chunks.get(b'EDGE')
+        self.num_commits = self._fanout[255]
+
+        if self.num_commits and self.generation(0) == 0:
+            # Written by a git too old to compute generation numbers
+            raise CommitGraphError('%s has no generation numbers' % path)
+
+    def lookup(self, oid):
+        """
+        Return the position of the commit with the given binary SHA-1 in
+        the graph, or `None` if it is not in the graph.
+        """
+
+        first = struct.unpack_from('B', oid)[0]
+        lo = self._fanout[first - 1] if first else 0
+        hi = self._fanout[first]
+        data = self._data
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self._oids + mid * _HASH_LEN
+            mid_oid = data[start:start + _HASH_LEN]
+            if mid_oid < oid:
+                lo = mid + 1
+            elif mid_oid > oid:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def oid(self, pos):
+        start = self._oids + pos * _HASH_LEN
+        return self._data[start:start + _HASH_LEN]
+
+    def generation(self, pos):
+        offset = self._cdat + pos * _CDAT_WIDTH + _HASH_LEN + 8
+        return struct.unpack_from('>I', self._data, offset)[0] >> 2
+
+    def commit(self, pos):
+        """
+        Return the generation number, commit time, and list of parent
+        positions of the commit at the given position.
+        """
+
+        _, parent1, parent2, gen_time, time_low = struct.unpack_from(
+                '>20sIIII', self._data, self._cdat + pos * _CDAT_WIDTH)
+
+        parents = []
+        if parent1 != _PARENT_NONE:
+            parents.append(parent1)
+
+        if parent2 == _PARENT_NONE:
+            pass
+        elif parent2 & _EXTRA_EDGES:
+            # Octopus merge: the remaining parents are in the EDGE chunk
+            offset = self._edges + 4 * (parent2 & _EDGE_MASK)
+            while True:
+                edge = struct.unpack_from('>I', self._data, offset)[0]
+                parents.append(edge & _EDGE_MASK)
+                if edge & _EXTRA_EDGES:
+                    break
+                offset += 4
+        else:
+            parents.append(parent2)
+
+        commit_time = ((gen_time & 3) << 32) | time_low
+        return gen_time >> 2, commit_time, parents
+
+
+class CommitGraphFile(object):
+    """
+    Holds the `CommitGraph` of a repository, reloading it when the file
+    changes on disk.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.join(path, 'objects', 'info', 'commit-graph')
+        self._lock = threading.Lock()
+        self._graph = None
+        self._stamp = None
+
+    def get(self):
+        """
+        Return the current `CommitGraph`, or `None` if the repository has no
+        (readable) commit-graph file.
+        """
+
+        with self._lock:
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                st = None
+
+            if st is None or not stat.S_ISREG(st.st_mode):
+                stamp = None
+            else:
+                stamp = (st.st_mtime, st.st_size, st.st_ino)
+
+            if stamp != self._stamp:
+                # The old graph is not closed, since it may still be in use
+                # by another thread; it is unmapped once no longer referenced
+                self._graph = None
+                self._stamp = stamp
+                if stamp is not None:
+                    try:
+                        self._graph = CommitGraph(self.path)
+                    except (CommitGraphError, EnvironmentError,
+                            ValueError, struct.error):
+                        self._graph = None
+
+            return self._graph
+
+
+class Reachability(object):
+    """
+    Answers reachability queries between commits of a repository using its
+    `CommitGraph`, reading commits missing from the graph through pygit2.
+
+    Commits are given and returned as hex SHA-1s.  Instances memoize the
+    commits they read, so should only be used for a single query.
+    """
+
+    _TIP = 1
+    _HIDDEN = 2
+
+    def __init__(self, graph, repo):
+        self.graph = graph
+        self.repo = repo
+        # Maps hex SHA-1s to (generation, commit time, parent hexes)
+        self._commits = {}
+
+    def is_ancestor(self, ancestor, descendant):
+        """
+        Return True if ``ancestor`` is ``descendant`` or one of its
+        ancestors.
+
+        Only commits with a generation number greater than that of
+        ``ancestor`` are visited.
+        """
+
+        if ancestor == descendant:
+            return True
+
+        generation = self._commit(ancestor)[0]
+        if self._commit(descendant)[0] <= generation:
+            return False
+
+        stack = [descendant]
+        seen = set(stack)
+        while stack:
+            for parent in self._commit(stack.pop())[2]:
+                if parent == ancestor:
+                    return True
+                if parent not in seen:
+                    seen.add(parent)
+                    if self._commit(parent)[0] > generation:
+                        stack.append(parent)
+
+        return False
+
+    def difference(self, tips, hidden=(), limit=None):
+        """
+        Return the commits reachable from any of ``tips`` but not from any
+        of ``hidden`` (like ``git rev-list tips --not hidden``), children
+        before their parents and otherwise newest first.
+
+        Commits are visited in order of decreasing generation number, so
+        each commit's flags are final by the time it is visited and the walk
+        stops as soon as only commits reachable from ``hidden`` remain.
+        """
+
+        flags = {}
+        queue = []
+        # Number of queued commits reachable only from tips
+        active = [0]
+
+        def mark(commit, flag):
+            old = flags.get(commit)
+            if old is None:
+                generation, commit_time, _ = self._commit(commit)
+                flags[commit] = flag
+                heapq.heappush(queue, (-generation, -commit_time, commit))
+                if flag == self._TIP:
+                    active[0] += 1
+            elif old == self._TIP and flag & self._HIDDEN:
+                flags[commit] = old | flag
+                active[0] -= 1
+
+        for commit in tips:
+            mark(commit, self._TIP)
+        for commit in hidden:
+            mark(commit, self._HIDDEN)
+
+        result = []
+        while active[0] > 0:
+            if limit is not None and len(result) >= limit:
+                break
+
+            commit = heapq.heappop(queue)[2]
+            flag = flags[commit]
+            if flag == self._TIP:
+                active[0] -= 1
+                result.append(commit)
+
+            for parent in self._commit(commit)[2]:
+                mark(parent, flag)
+
+        return result
+
+    def _commit(self, hex):
+        try:
+            return self._commits[hex]
+        except KeyError:
+            pass
+
+        graph = self.graph
+        pos = graph.lookup(binascii.unhexlify(hex))
+        if pos is not None:
+            generation, commit_time, parents = graph.commit(pos)
+            info = self._commits[hex] = (generation, commit_time, [
+                binascii.hexlify(graph.oid(p)).decode('ascii')
+                for p in parents])
+            return info
+
+        return self._read_commits(hex)
+
+    def _read_commits(self, hex):
+        # Commits added since the commit-graph was written; since the graph
+        # includes all ancestors of the commits in it, computing generation
+        # numbers for these only walks back to the commits in the graph
+        stack = [hex]
+        while stack:
+            current = stack[-1]
+            if current in self._commits:
+                stack.pop()
+                continue
+
+            commit = self.repo[current]
+            parents = [p.hex for p in commit.parents]
+            missing = []
+            for parent in parents:
+                if parent in self._commits:
+                    continue
+                pos = self.graph.lookup(binascii.unhexlify(parent))
+                if pos is None:
+                    missing.append(parent)
+                else:
+                    self._commit(parent)
+
+            if missing:
+                stack.extend(missing)
+                continue
+
+            generation = 1 + max([self._commits[p][0] for p in parents] or
+                                 [0])
+            self._commits[current] = (generation, commit.commit_time,
+                                      parents)
+            stack.pop()
+
+        return self._commits[hex]
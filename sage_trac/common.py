@@ -1,17 +1,30 @@
 # -*- coding: utf-8 -*-
 
 from trac.core import Component, TracError, implements
-from trac.config import Option, PathOption
+from trac.config import ChoiceOption, IntOption, Option, PathOption
 from trac.db.api import DatabaseManager
 from trac.env import IEnvironmentSetupParticipant
 
+import collections
+import importlib
+import itertools
+import multiprocessing
 import pygit2
 import re
 import os
+import select
+import signal
+import socket
+import stat
 import subprocess
+import sys
+import threading
+import time
 import urllib
 import urlparse
 
+from .commit_graph import CommitGraphFile, Reachability
+
 
 # Simple regexp for "Name <email>" signatures
 _signature_re = re.compile(r'\s*(.*\S)\s*<(.+@.+)>\s*$')
@@ -29,34 +42,519 @@ def hexify(*args):
     return res
 
 
+def _chunks(seq, size=500):
+    """
+    Split a sequence into chunks of at most ``size`` items, e.g. to keep
+    the number of parameters in ``IN (...)`` clauses reasonable.
+    """
+
+    seq = list(seq)
+    for idx in range(0, len(seq), size):
+        yield seq[idx:idx + size]
+
+
+class LRUCache(object):
+    """
+    A simple thread-safe mapping which holds at most ``size`` items,
+    discarding the least recently used items first.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._items = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class GitProcess(object):
+    """
+    A ``git`` subprocess whose combined stdout and stderr can be streamed
+    line by line by iterating over it.
+
+    The command runs in the directory ``cwd`` if given, and on the
+    repository ``git_dir`` if given; the current directory of the calling
+    process is never changed, so any number of commands may be run
+    concurrently from different threads.  If ``timeout`` is given the
+    process is killed if it has not exited after that many seconds.
+
+    The process runs in its own process group, which is killed as a whole
+    on timeout, so that helpers started by git (remote helpers, ``ssh``,
+    shell aliases) do not outlive it and keep its output pipe open.
+    """
+
+    _poll_interval = 0.5
+
+    def __init__(self, args, cwd=None, git_dir=None, timeout=None):
+        cmd = ['git']
+        if git_dir:
+            cmd.append('--git-dir=' + git_dir)
+        cmd.extend(args)
+
+        self.timeout = timeout
+        self.timed_out = False
+        self.returncode = None
+        if sys.version_info[0] >= 3:
+            session = {'start_new_session': True}
+        else:
+            session = {'preexec_fn': os.setsid}
+
+        self._proc = subprocess.Popen(cmd, cwd=cwd or None,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.STDOUT,
+                                      close_fds=True, **session)
+
+        if timeout:
+            self._timer = threading.Timer(timeout, self._kill)
+            self._timer.daemon = True
+            self._timer.start()
+        else:
+            self._timer = None
+
+    def __iter__(self):
+        try:
+            buf = b''
+            for chunk in self._read():
+                lines = (buf + chunk).split(b'\n')
+                buf = lines.pop()
+                for line in lines:
+                    yield (line + b'\n').decode('latin1')
+            if buf:
+                yield buf.decode('latin1')
+        finally:
+            self.wait()
+
+    def _read(self):
+        """
+        Yield the output of the process in chunks until it closes its end of
+        the pipe or, once it has been killed on timeout, until it has exited
+        (in case a descendant that left its process group holds the pipe).
+        """
+
+        fd = self._proc.stdout.fileno()
+        while True:
+            if select.select([fd], [], [], self._poll_interval)[0]:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    return
+                yield chunk
+            elif self.timed_out and self._proc.poll() is not None:
+                return
+
+    def wait(self):
+        """
+        Wait for the process to exit, discarding any remaining output, and
+        return its exit code.
+        """
+
+        if self.returncode is None:
+            for _ in self._read():
+                pass
+            self._proc.stdout.close()
+            self.returncode = self._proc.wait()
+            if self._timer is not None:
+                self._timer.cancel()
+
+        return self.returncode
+
+    def _kill(self):
+        self.timed_out = True
+        try:
+            os.killpg(self._proc.pid, signal.SIGKILL)
+        except OSError:
+            # Already exited, along with everything it started
+            pass
+
+
 def run_git(*args, **kwargs):
     """
-    Run the ``git`` command with the given arguments.
+    Run the ``git`` command with the given arguments, and return its exit
+    code and output.
 
-    If given, change directory to the one specified by ``chdir``; otherwise run
-    ``git`` in the current directory.
+    Accepts the same keyword arguments as `GitProcess`.  For backwards
+    compatibility ``chdir`` is accepted as an alias for ``cwd``.
     """
 
     chdir = kwargs.pop('chdir', None)
+    cwd = kwargs.pop('cwd', None) or chdir
+
+    if cwd and not os.path.isdir(cwd):
+        return (-1, 'Cannot change directories to %s; '
+                    'it does not exist yet or is not a directory.' % cwd)
+
+    proc = GitProcess(args, cwd=cwd, **kwargs)
+    out = u''.join(proc)
+
+    if proc.timed_out:
+        out += u'\ngit %s timed out after %s seconds' % (args[0],
+                                                          proc.timeout)
+
+    return proc.returncode, out
+
+
+def worker_id():
+    """
+    Return an identifier for the current process, for claiming queued jobs.
+    """
+
+    return '%s:%s' % (socket.gethostname(), os.getpid())
+
+
+# The Trac environment opened by each process in a WorkerPool
+_worker_env = None
+
+
+def _init_worker(env_path):
+    global _worker_env
+    from trac.env import open_environment
+    _worker_env = open_environment(env_path, use_cache=False)
+
+
+def _call_worker(job):
+    module, name, method, args = job
+    cls = getattr(importlib.import_module(module), name)
+    return getattr(cls(_worker_env), method)(*args)
 
-    prev_dir = os.getcwd()
-    if chdir:
-        if os.path.isdir(chdir):
-            os.chdir(chdir)
+
+class WorkerPool(object):
+    """
+    A pool of worker processes, each of which opens its own instance of the
+    Trac environment and calls methods on its own instance of the given
+    Component class.
+
+    Since each worker has its own database connections and repository
+    handles nothing is shared with the parent process, so this is safe to
+    use for jobs that take a long time or touch the git repository.
+    """
+
+    def __init__(self, component, processes=None):
+        cls = component.__class__
+        self._cls = (cls.__module__, cls.__name__)
+        self._pool = multiprocessing.Pool(processes, _init_worker,
+                                          (component.env.path,))
+
+    def apply_async(self, method, args=(), callback=None):
+        return self._pool.apply_async(_call_worker,
+                                      (self._cls + (method, args),),
+                                      callback=callback)
+
+    def map(self, method, args_list):
+        return self._pool.map(_call_worker,
+                              [self._cls + (method, args)
+                               for args in args_list])
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+# Ref names that could escape the refs directory are never looked up on disk
+_bad_ref_re = re.compile(r'(^|/)\.\.?(/|$)|^/|//|\\|\x00')
+
+
+class RefIndex(object):
+    """
+    Index of the refs in a repository mapping ref names to the SHA-1 hashes
+    of the objects they point to.
+
+    The contents of ``packed-refs`` are parsed once and reparsed only when
+    that file changes, and loose refs are reread only when their files
+    change, so that a lookup (including of a nonexistent ref) costs at most
+    a couple of ``stat`` calls.  Counts of cache hits, misses (refs that had
+    to be read from disk), and negative lookups are kept in ``stats``.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stats = {'hits': 0, 'misses': 0, 'negative': 0}
+        self._lock = threading.Lock()
+        self._packed = {}
+        self._packed_stamp = None
+        # Maps loose ref names to (file stamp, target)
+        self._loose = {}
+
+    def lookup(self, name):
+        """
+        Return the hex SHA-1 of the object the named ref (e.g.
+        ``refs/heads/develop``) points to, or `None` if it does not exist.
+
+        Symbolic refs are followed.
+        """
+
+        if _bad_ref_re.search(name):
+            return None
+
+        with self._lock:
+            return self._lookup(name)
+
+    def _lookup(self, name, depth=0):
+        path = os.path.join(self.path, name)
+        stamp = self._file_stamp(path)
+
+        if stamp is None:
+            self._loose.pop(name, None)
+            self._load_packed()
+            target = self._packed.get(name)
+            if target is None:
+                self.stats['negative'] += 1
+            else:
+                self.stats['hits'] += 1
+            return target
+
+        cached = self._loose.get(name)
+        if cached is not None and cached[0] == stamp:
+            self.stats['hits'] += 1
+            target = cached[1]
         else:
-            return (-1, 'Cannot change directories to %s; '
-                        'it does not exist yet or is not a directory.')
-    try:
-        out = subprocess.check_output(('git',) + args,
-                                      stderr=subprocess.STDOUT)
-        code = 0
-    except subprocess.CalledProcessError as exc:
-        out, code = exc.output, exc.returncode
-    finally:
-        if chdir:
-            os.chdir(prev_dir)
+            self.stats['misses'] += 1
+            try:
+                with open(path) as f:
+                    target = f.read().strip()
+            except IOError:
+                return None
+            self._loose[name] = (stamp, target)
+
+        if target.startswith('ref: '):
+            if depth >= 5 or _bad_ref_re.search(target[5:]):
+                return None
+            return self._lookup(target[5:], depth + 1)
+
+        return target
+
+    def _load_packed(self):
+        path = os.path.join(self.path, 'packed-refs')
+        stamp = self._file_stamp(path)
+        if stamp == self._packed_stamp:
+            return
+
+        packed = {}
+        if stamp is not None:
+            with open(path) as f:
+                for line in f:
+                    # Skip the header and peeled tag lines
+                    if not line.strip() or line[0] in '#^':
+                        continue
+                    target, name = line.split(None, 1)
+                    packed[name.strip()] = target
+
+        self._packed = packed
+        self._packed_stamp = stamp
+
+    @staticmethod
+    def _file_stamp(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        if not stat.S_ISREG(st.st_mode):
+            return None
+
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+
+class CatFile(object):
+    """
+    A long-lived ``git cat-file --batch`` (or ``--batch-check`` if ``check``
+    is True) co-process for reading objects from a repository without
+    starting a new ``git`` process for each read.
+
+    The co-process is started on first use, and restarted if it dies.
+    """
+
+    def __init__(self, path, check=False):
+        self.path = path
+        self.check = check
+        self._lock = threading.Lock()
+        self._proc = None
+
+    def read(self, spec):
+        """
+        Look up the object named by ``spec`` (a SHA-1 or anything else
+        understood by ``git rev-parse``).
+
+        Returns `None` if the object does not exist, otherwise a tuple of
+        the object's hex SHA-1 and type, followed by its contents unless this
+        is a ``--batch-check`` process.
+        """
+
+        if not spec or '\n' in spec:
+            return None
+
+        with self._lock:
+            try:
+                return self._read(spec)
+            except (IOError, OSError, ValueError):
+                # Try once more with a fresh process
+                self._close()
+                return self._read(spec)
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _read(self, spec):
+        if self._proc is None or self._proc.poll() is not None:
+            self._start()
+
+        self._proc.stdin.write(spec.encode('utf-8') + b'\n')
+        self._proc.stdin.flush()
+
+        header = self._proc.stdout.readline().decode('latin1')
+        if not header:
+            raise IOError('git cat-file exited unexpectedly')
+
+        fields = header.split()
+        if fields[-1] in ('missing', 'ambiguous'):
+            return None
+
+        hex, type_, size = fields
+        if self.check:
+            return hex, type_
+
+        data = self._proc.stdout.read(int(size))
+        # Each object is followed by a newline
+        self._proc.stdout.read(1)
+        return hex, type_, data
+
+    def _start(self):
+        mode = '--batch-check' if self.check else '--batch'
+        self._proc = subprocess.Popen(
+                ['git', '--git-dir=' + self.path, 'cat-file', mode],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                close_fds=True)
+
+    def _close(self):
+        if self._proc is not None:
+            try:
+                self._proc.stdin.close()
+                self._proc.wait()
+            except (IOError, OSError):
+                pass
+            self._proc = None
+
+
+_object_types = {
+    pygit2.GIT_OBJ_COMMIT: 'commit',
+    pygit2.GIT_OBJ_TREE: 'tree',
+    pygit2.GIT_OBJ_BLOB: 'blob',
+    pygit2.GIT_OBJ_TAG: 'tag'
+}
+
+
+class RepositoryRegistry(object):
+    """
+    Process-wide registry of pygit2 Repository handles.
+
+    All Components using the same repository share a single handle (and
+    with it libgit2's object cache and packfile mmaps) per process.  The
+    handle is reopened when the repository's packs or packed refs change
+    on disk (e.g. after a push or ``git gc``), which is checked at most
+    once every ``check_interval`` seconds.
+    """
+
+    check_interval = 1
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        # Maps repository paths to [repository, stamp, last check time]
+        self._entries = {}
+        # Other per-repository helpers, such as RefIndex and CatFile
+        self._helpers = {}
+        self._cache_size = None
+
+    def get(self, path, cache_size=0):
+        now = time.time()
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # Handles inherited from the parent of a forked process are
+                # not reused
+                self._reset()
+
+            if cache_size and cache_size != self._cache_size:
+                # This setting is global to libgit2
+                if hasattr(pygit2, 'settings'):
+                    pygit2.settings.cache_max_size(cache_size * 1024 * 1024)
+                self._cache_size = cache_size
+
+            entry = self._entries.get(path)
+            if entry is not None and now - entry[2] < self.check_interval:
+                return entry[0]
 
-    return code, out.decode('latin1')
+            stamp = self._stamp(path)
+            if entry is None or entry[1] != stamp:
+                entry = self._entries[path] = [pygit2.Repository(path),
+                                               stamp, now]
+            else:
+                entry[2] = now
+
+            return entry[0]
+
+    def ref_index(self, path):
+        return self._helper(RefIndex, path)
+
+    def cat_file(self, path, check=False):
+        return self._helper(CatFile, path, check)
+
+    def commit_graph(self, path):
+        return self._helper(CommitGraphFile, path).get()
+
+    def _helper(self, cls, path, *args):
+        key = (cls, path) + args
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+
+            try:
+                return self._helpers[key]
+            except KeyError:
+                helper = self._helpers[key] = cls(path, *args)
+                return helper
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._entries = {}
+        self._helpers = {}
+        self._cache_size = None
+
+    def _stamp(self, path):
+        stamp = []
+        for name in ('packed-refs', os.path.join('objects', 'pack')):
+            try:
+                stamp.append(os.stat(os.path.join(path, name)).st_mtime)
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+
+repositories = RepositoryRegistry()
 
 
 class GitBase(Component):
@@ -85,6 +583,39 @@ class GitBase(Component):
     cgit_repo = Option('sage_trac', 'cgit_repository', '',
                        doc="name of the project's repository under cgit")
 
+    git_timeout = IntOption(
+            'sage_trac', 'git_timeout', 600,
+            doc='number of seconds after which git commands run on the '
+                'repository (e.g. to fetch branches) are aborted '
+                '(default: 600)')
+
+    repository_cache_size = IntOption(
+            'sage_trac', 'repository_cache_size', 0,
+            doc='maximum size in MiB of the object cache libgit2 keeps for '
+                'the repository in each process (default: 0, meaning use '
+                "libgit2's default)")
+
+    object_reader = ChoiceOption(
+            'sage_trac', 'object_reader', ['pygit2', 'cat-file'],
+            doc='how `object_info` and `read_object` read objects from the '
+                'repository: either in-process through "pygit2" (the '
+                'default), or through long-lived "cat-file" (`git cat-file '
+                '--batch`) processes, which fall back to pygit2 if git '
+                'cannot be run')
+
+    log_cache_size = IntOption(
+            'sage_trac', 'log_cache_size', 100,
+            doc='number of commit log tables (as posted to tickets when '
+                'their branch is updated) cached by each component using '
+                'them, in each process, keyed by the branch tip and the '
+                'commits hidden from the log (default: 100)')
+
+    changed_paths_cache_size = IntOption(
+            'sage_trac', 'changed_paths_cache_size', 100,
+            doc='number of sets of changed paths between two commits cached '
+                'by each component using them, in each process (default: '
+                '100)')
+
     abstract = True
 
     def __init__(self, *args, **kwds):
@@ -108,32 +639,246 @@ class GitBase(Component):
             self._cgit_host = url_split[:2]
             self._cgit_path = url_split[2].rstrip('/')
 
+        self._log_cache = LRUCache(self.log_cache_size)
+        self._changed_paths_cache = LRUCache(self.changed_paths_cache_size)
+
     @property
     def _git(self):
-        try:
-            return self.__git
-        except AttributeError:
-            self.__git = pygit2.Repository(self.git_dir)
-            return self.__git
+        return repositories.get(self.git_dir, self.repository_cache_size)
+
+    @property
+    def ref_index(self):
+        return repositories.ref_index(self.git_dir)
 
     @property
     def master(self):
-        b = self._git.lookup_branch(self.master_branch)
-        if b is not None:
-            return b.get_object()
-        return b
+        return self.lookup_branch(self.master_branch)
+
+    def lookup_branch(self, branch):
+        """
+        Return the commit at the tip of the given branch, or `None` if the
+        branch does not exist.
+        """
+
+        return self._lookup_ref('refs/heads/' + branch)
 
     def generic_lookup(self, ref_or_sha):
         for s in ('refs/heads/', 'refs/tags/'):
             # check for branches then tags
-            try:
-                return (False,
-                        self._git.lookup_reference(s + ref_or_sha).get_object())
-            except KeyError:
-                pass
+            obj = self._lookup_ref(s + ref_or_sha)
+            if obj is not None:
+                return (False, obj)
         # try raw sha1 hexes if all else fails
         return (True, self._git[ref_or_sha])
 
+    def object_info(self, spec):
+        """
+        Return the hex SHA-1 and type name (e.g. ``'commit'``) of the object
+        named by ``spec``, or `None` if there is no such object.
+        """
+
+        ret = self._read_object(spec, True)
+        return ret and ret[:2]
+
+    def read_object(self, spec):
+        """
+        Return the hex SHA-1, type name, and raw contents of the object named
+        by ``spec``, or `None` if there is no such object.
+        """
+
+        return self._read_object(spec, False)
+
+    def _read_object(self, spec, check):
+        if self.object_reader == 'cat-file':
+            try:
+                return repositories.cat_file(self.git_dir, check).read(spec)
+            except (IOError, OSError, ValueError) as exc:
+                self.log.warning('Reading %s with git cat-file failed; '
+                                 'falling back to pygit2: %s', spec, exc)
+
+        try:
+            obj = self._git.revparse_single(spec)
+        except (KeyError, ValueError):
+            return None
+
+        ret = (obj.hex, _object_types.get(obj.type))
+        if not check:
+            ret += (obj.read_raw(),)
+        return ret
+
+    @property
+    def commit_graph(self):
+        """
+        The repository's `CommitGraph`, or `None` if it has none.
+        """
+
+        return repositories.commit_graph(self.git_dir)
+
+    def is_ancestor(self, ancestor, descendant):
+        """
+        Return True if the commit ``ancestor`` is ``descendant`` or one of
+        its ancestors.
+
+        Both may be given as commits, Oids, or hex SHA-1s.  This uses the
+        repository's commit-graph if it has one.
+        """
+
+        ancestor, descendant = hexify(ancestor, descendant)
+        graph = self.commit_graph
+        if graph is not None:
+            return Reachability(graph, self._git).is_ancestor(
+                    str(ancestor), str(descendant))
+
+        ancestor = self._git[ancestor].oid
+        descendant = self._git[descendant].oid
+        return self._git.merge_base(ancestor, descendant) == ancestor
+
+    def ancestry_difference(self, tip, hidden=(), limit=None):
+        """
+        Return the hex SHA-1s of up to ``limit`` commits reachable from
+        ``tip`` but not from any of the commits in ``hidden``, newest first.
+
+        Commits may be given as commits, Oids, or hex SHA-1s.  This uses the
+        repository's commit-graph if it has one.
+        """
+
+        tip = str(hexify(tip))
+        hidden = [str(hexify(c)) for c in hidden]
+        graph = self.commit_graph
+        if graph is not None:
+            return Reachability(graph, self._git).difference(
+                    [tip], hidden, limit)
+
+        walker = self._git.walk(self._git[tip].oid,
+                pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_TIME)
+        for commit in hidden:
+            walker.hide(self._git[commit].oid)
+
+        return [commit.hex for commit in itertools.islice(walker, limit)]
+
+    def iter_log(self, tip, ignore=(), limit=None):
+        """
+        Iterate over the commits reachable from ``tip`` but not from any of
+        the branches or commits named in ``ignore``, newest first, yielding
+        the hex SHA-1 and summary line of each commit.
+
+        At most ``limit`` commits are read from the repository.
+        """
+
+        return self._iter_log(tip, self._log_hidden(ignore), limit)
+
+    def _iter_log(self, tip, hidden, limit):
+        for commit in self.ancestry_difference(tip, hidden, limit):
+            message = self._git[commit].message
+            end = message.find('\n')
+            if end >= 0:
+                message = message[:end]
+            yield commit, message.rstrip('\r')
+
+    def log_table(self, new_commit, limit=None, ignore=()):
+        """
+        Return the commit log of ``new_commit`` (see `iter_log`) as a list of
+        rows of a wiki table linking to each commit.
+
+        Tables are cached by each component instance, in each process, so
+        repeated posts of the same branch update by one component only walk
+        the history once; `TicketLog` and the GitLab webhook each keep their
+        own cache.
+        """
+
+        tip = hexify(self._git[new_commit])
+        hidden = self._log_hidden(ignore)
+        key = (tip, frozenset(hidden), limit)
+        table = self._log_cache.get(key)
+        if table is None:
+            table = self._log_cache[key] = tuple(
+                u'||[%s %s]||{{{%s}}}||' % (self.commit_url(commit),
+                                           commit[:7], title)
+                for commit, title in self._iter_log(tip, hidden, limit))
+
+        return list(table)
+
+    def _log_hidden(self, ignore):
+        hidden = []
+        for name in ignore:
+            commit = self.lookup_branch(name)
+            if commit is None:
+                try:
+                    commit = self._git.get(name)
+                except ValueError:
+                    continue
+
+            if commit is not None:
+                hidden.append(commit.hex)
+
+        return hidden
+
+    def changed_paths(self, ancestor, descendant, renames=False):
+        """
+        Return the set of paths of the files that differ between the trees
+        of the commits ``ancestor`` and ``descendant``.
+
+        Only the trees are compared, so file contents are never read.  Both
+        the old and the new path of a file that was moved are included,
+        unless ``renames`` is True, in which case renames are detected (by
+        content similarity, which does read the files involved) and only
+        reported under their new path.
+
+        Commits may be given as commits, Oids, or hex SHA-1s.  Results are
+        cached per pair of commits.
+        """
+
+        ancestor, descendant = hexify(ancestor, descendant)
+        key = (ancestor, descendant, renames)
+        paths = self._changed_paths_cache.get(key)
+        if paths is None:
+            paths = self._changed_paths_cache[key] = self._changed_paths(
+                    ancestor, descendant, renames)
+        return paths
+
+    def _changed_paths(self, ancestor, descendant, renames):
+        paths = set()
+        if ancestor == descendant:
+            return frozenset(paths)
+
+        diff = self._git.diff(self._git[ancestor].tree,
+                              self._git[descendant].tree)
+        if renames:
+            diff.find_similar()
+
+        for delta in diff.deltas:
+            if not (renames and delta.status == pygit2.GIT_DELTA_RENAMED):
+                paths.add(delta.old_file.path)
+            paths.add(delta.new_file.path)
+
+        return frozenset(paths)
+
+    def write_commit_graph(self):
+        """
+        (Re)write the repository's commit-graph file for all commits
+        reachable from its refs.
+
+        Returns True on success.
+        """
+
+        code, out = run_git('commit-graph', 'write', '--reachable',
+                            git_dir=self.git_dir, timeout=self.git_timeout)
+        if code:
+            self.log.warning('Writing the commit-graph of %s failed: %s',
+                             self.git_dir, out)
+        return code == 0
+
+    def _lookup_ref(self, name):
+        target = self.ref_index.lookup(name)
+        if target is None:
+            return None
+
+        obj = self._git.get(target)
+        # Peel annotated tags
+        while isinstance(obj, pygit2.Tag):
+            obj = self._git.get(obj.target)
+        return obj
+
     def _cgit_url(self, path='', query={}, fragment=''):
         if not isinstance(path, str):
             path = '/'.join(path)
@@ -214,6 +959,35 @@ class GenericTableProvider(Component):
 
         raise NotImplementedError
 
+    def _create_tables(self, db, names):
+        """
+        Create the tables from this Component's schema with the given names
+        using the given database connection; for use in ``_upgrade_schema``
+        when new tables are added to the schema.
+
+        Tables that already exist are skipped: Components subclassing
+        another share its tables but record their schema version under their
+        own name, so the same upgrade may run once for each of them.
+        """
+
+        dbm = DatabaseManager(self.env)
+        connector, _ = dbm.get_connector()
+        existing = dbm.get_table_names()
+        for table in self._schema:
+            if table.name in names and table.name not in existing:
+                for stmt in connector.to_sql(table):
+                    db(stmt)
+
+    def _get_column_names(self, db, name):
+        """
+        Return the names of the columns of the given table as it currently
+        exists in the database.
+        """
+
+        cursor = db.cursor()
+        cursor.execute('SELECT * FROM "%s" WHERE 1=0' % name)
+        return [desc[0] for desc in cursor.description]
+
     # IEnvironmentSetupParticipant methods
     def environment_created(self):
         dbm = DatabaseManager(self.env)
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Scheduling of ``git fetch`` runs into the repository across processes.
+"""
+
+import contextlib
+import errno
+import hashlib
+import os
+import re
+import socket
+import threading
+import time
+import urlparse
+
+from fasteners import InterProcessLock as IPLock
+
+from trac.core import TracError
+
+
+_unsafe_re = re.compile(r'[^A-Za-z0-9_.-]')
+
+
+class FetchScheduler(object):
+    """
+    Limits concurrent fetches into a repository by all processes sharing
+    the lock directory ``lock_dir``.
+
+    A fetch must hold, in this order:
+
+    * the lock for the ref it updates, so that fetches into the same branch
+      are serialized rather than failing on git's ref lock;
+    * one of ``max_per_host`` slots for the host it fetches from;
+    * one of ``max_fetches`` global slots.
+
+    Since every fetch takes these in the same order, and nothing waits while
+    holding a global slot, this cannot deadlock.  Waiting and running
+    fetches are recorded as marker files in the lock directory so that
+    `status` can report the queue depth from any process.
+    """
+
+    poll_interval = 0.2
+
+    # Lock files held by this process; fcntl locks are per process, so this
+    # is what keeps threads of the same process from sharing a slot
+    _held = set()
+    _held_pid = None
+    _held_lock = threading.Lock()
+
+    def __init__(self, lock_dir, max_fetches=4, max_per_host=2, timeout=600):
+        self.lock_dir = lock_dir
+        self.max_fetches = max(max_fetches, 1)
+        self.max_per_host = max(max_per_host, 1)
+        self.timeout = timeout
+
+        for name in ('', 'waiting', 'running'):
+            try:
+                os.makedirs(os.path.join(lock_dir, name))
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+
+    @contextlib.contextmanager
+    def slot(self, url, ref):
+        """
+        Context manager that waits until a fetch from ``url`` into ``ref``
+        may run, and yields the number of seconds waited.
+
+        Raises `TracError` if no slot could be had within ``timeout``
+        seconds.
+        """
+
+        host = urlparse.urlsplit(url).hostname or 'local'
+        marker = self._marker_name()
+        waiting = self._mark('waiting', marker)
+        start = time.time()
+        deadline = start + self.timeout
+        locks = []
+
+        try:
+            try:
+                locks.append(self._acquire_lock(
+                    'ref-' + hashlib.sha1(ref.encode('utf-8')).hexdigest(),
+                    deadline))
+                locks.append(self._acquire_slot(
+                    'host-' + _unsafe_re.sub('_', host), self.max_per_host,
+                    deadline))
+                locks.append(self._acquire_slot('global', self.max_fetches,
+                                                deadline))
+            finally:
+                self._unmark(waiting)
+
+            running = self._mark('running', marker)
+            try:
+                yield time.time() - start
+            finally:
+                self._unmark(running)
+        finally:
+            for lock in reversed(locks):
+                self._release(lock)
+
+    def status(self):
+        """
+        Return a dict with the number of fetches ``waiting`` for a slot and
+        ``running``, and how long the longest waiting fetch has waited
+        (``max_wait``, in seconds).
+        """
+
+        now = time.time()
+        status = {'max_wait': 0}
+        for state in ('waiting', 'running'):
+            count = 0
+            for marker in self._markers(state):
+                count += 1
+                if state == 'waiting':
+                    status['max_wait'] = max(status['max_wait'],
+                                             now - marker[1])
+            status[state] = count
+
+        return status
+
+    def _acquire_lock(self, name, deadline):
+        while True:
+            lock = self._try_lock(name)
+            if lock is not None:
+                return lock
+            self._wait(deadline)
+
+    def _acquire_slot(self, prefix, count, deadline):
+        while True:
+            for idx in range(count):
+                lock = self._try_lock('{}-{}'.format(prefix, idx))
+                if lock is not None:
+                    return lock
+            self._wait(deadline)
+
+    def _try_lock(self, name):
+        path = os.path.join(self.lock_dir, name + '.lock')
+        cls = self.__class__
+        with cls._held_lock:
+            if cls._held_pid != os.getpid():
+                # Locks are not inherited by forked processes
+                cls._held = set()
+                cls._held_pid = os.getpid()
+
+            if path in cls._held:
+                return None
+            lock = IPLock(path)
+            if not lock.acquire(blocking=False):
+                return None
+            cls._held.add(path)
+            return path, lock
+
+    def _release(self, lock):
+        path, lock = lock
+        with self._held_lock:
+            self._held.discard(path)
+            lock.release()
+
+    def _wait(self, deadline):
+        if time.time() >= deadline:
+            raise TracError('timed out after {} seconds waiting to '
+                            'fetch'.format(self.timeout))
+        time.sleep(self.poll_interval)
+
+    @staticmethod
+    def _marker_name():
+        return '{}:{}:{}'.format(socket.gethostname(), os.getpid(),
+                                 threading.current_thread().ident)
+
+    def _mark(self, state, marker):
+        path = os.path.join(self.lock_dir, state, marker)
+        with open(path, 'w'):
+            pass
+        return path
+
+    def _unmark(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def _markers(self, state):
+        """
+        Yield the name and modification time of each marker file for the
+        given state, removing those left behind by dead processes on this
+        host.
+        """
+
+        directory = os.path.join(self.lock_dir, state)
+        hostname = socket.gethostname()
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                host, pid, _ = name.rsplit(':', 2)
+                mtime = os.stat(path).st_mtime
+            except (ValueError, OSError):
+                continue
+
+            if host == hostname and not _pid_exists(int(pid)):
+                self._unmark(path)
+                continue
+
+            yield name, mtime
+
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno == errno.EPERM
+    return True
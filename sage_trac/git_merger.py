@@ -3,31 +3,49 @@
 import re
 import shutil
 import tempfile
+import time
 import os.path
 
+import pkg_resources
 import pygit2
 
-from .common import (GitBase, _signature_re, GenericTableProvider, run_git)
+from .common import (GitBase, _signature_re, _chunks, GenericTableProvider,
+                     run_git, worker_id, WorkerPool)
 
+from trac.admin.api import AdminCommandError, IAdminCommandProvider
 from trac.core import implements, TracError
-from trac.config import Option
-from trac.db.schema import Table, Column
+from trac.config import (BoolOption, ChoiceOption, IntOption, ListOption,
+                         Option)
+from trac.db.schema import Table, Column, Index
 from trac.ticket.model import Ticket
+from trac.util.text import exception_to_unicode, printout
 from trac.web import IRequestHandler
-from trac.web.chrome import add_warning
+from trac.web.chrome import ITemplateProvider, add_warning
 from tracrpc.api import IXMLRPCHandler
 
 GIT_SPECIAL_MERGES = ('GIT_FASTFORWARD', 'GIT_UPTODATE', 'GIT_FAILED_MERGE')
 for _merge in GIT_SPECIAL_MERGES:
     globals()[_merge] = _merge
 
+# Returned by getMerges for merges queued to be computed; never cached
+GIT_PENDING_MERGE = 'GIT_PENDING_MERGE'
+
+# Priority of merges queued by users waiting on a merge preview; background
+# jobs are queued with lower priorities
+MERGE_PRIORITY_INTERACTIVE = 1000
+
+# Full or abbreviated SHA-1s, as accepted for merge previews; anything else
+# passed to object_info could be a revision expression
+_sha1_re = re.compile(r'[0-9a-fA-F]{4,40}$')
+
 
 def signature_eq(sig1, sig2):
     return sig1.name == sig2.name and sig1.email == sig2.email
 
 
 class GitMerger(GitBase, GenericTableProvider):
-    implements(IXMLRPCHandler, IRequestHandler)
+    implements(IXMLRPCHandler, IRequestHandler, IAdminCommandProvider,
+               ITemplateProvider)
 
     trac_signature = Option(
             'sage_trac', 'trac_signature', 'trac <trac@sagemath.org>',
@@ -35,15 +53,123 @@ class GitMerger(GitBase, GenericTableProvider):
                 'for commits made to the Git repository by the Trac '
                 'plugin (default: trac <trac@sagemath.org>)')
 
+    release_manager_signature = Option(
+            'sage_trac', 'release_manager_signature',
+            'Release Manager <release@sagemath.org>',
+            doc='signature to use on commits (especially merges) made '
+                'through action of the project release manager (default: '
+                '"Release Manager <release@sagemath.org>)')
+
+    merge_mode = ChoiceOption(
+            'sage_trac', 'merge_mode', ['memory', 'clone'],
+            doc='method used to generate merge previews: "memory" (the '
+                'default) merges the trees directly in the bare repository '
+                'without creating a working tree, while "clone" performs '
+                'the merge in a temporary clone of the repository; the '
+                'clone method is also used as a fallback if the installed '
+                'pygit2 does not support in-memory merges')
+
+    merge_in_background = BoolOption(
+            'sage_trac', 'merge_in_background', 'false',
+            doc='if enabled, merge previews requested through /git-merger '
+                'are queued and computed by background workers (run with '
+                '`trac-admin <env> merger work`) instead of inside the web '
+                'request, and the user is shown a page that reloads until '
+                'the merge is ready')
+
+    merge_workers = IntOption(
+            'sage_trac', 'merge_workers', 2,
+            doc='number of worker processes used to compute queued merge '
+                'previews (default: 2)')
+
+    merge_poll_interval = IntOption(
+            'sage_trac', 'merge_poll_interval', 2,
+            doc='number of seconds between reloads of the page shown while '
+                'a queued merge preview is being computed, and between '
+                'checks of the merge queue by idle workers (default: 2)')
+
+    merge_job_timeout = IntOption(
+            'sage_trac', 'merge_job_timeout', 600,
+            doc='number of seconds after which a queued merge claimed by a '
+                'worker that never finished it may be claimed by another '
+                'worker (default: 600)')
+
+    merge_max_attempts = IntOption(
+            'sage_trac', 'merge_max_attempts', 3,
+            doc='number of times a queued merge that fails with an '
+                'unexpected error is attempted before it is recorded as a '
+                'failed merge, so that it is not queued again (default: 3)')
+
+    warm_statuses = ListOption(
+            'sage_trac', 'merge_warm_statuses',
+            'needs_review, positive_review',
+            doc='statuses of the tickets whose merge previews are '
+                'recomputed by `trac-admin <env> merger warm` when the '
+                'master branch moves')
+
+    warm_interval = IntOption(
+            'sage_trac', 'merge_warm_interval', 60,
+            doc='number of seconds between checks for a new tip of the '
+                'master branch by `trac-admin <env> merger warm --daemon` '
+                '(default: 60)')
+
+    _warm_tip_key = 'sage_trac.merge_warm_tip'
+    """
+    Key in the system table under which the master branch tip for which the
+    merge cache was last warmed is stored.
+    """
+
+    _merge_index_tip_key = 'sage_trac.merge_index_tip'
+    """
+    Key in the system table under which the master branch tip up to which
+    release manager merges have been added to the merge_commit_index table
+    is stored.
+    """
+
+    merge_cache_bases = IntOption(
+            'sage_trac', 'merge_cache_bases', 3,
+            doc='number of different bases (e.g. successive tips of the '
+                'master branch, or other base branches) for which merge '
+                'previews of the same commit are cached; the least recently '
+                'used are evicted first (default: 3)')
+
+    write_commit_graph_on_warm = BoolOption(
+            'sage_trac', 'merge_warm_commit_graph', True,
+            doc='whether `trac-admin <env> merger warm --daemon` rewrites '
+                "the repository's commit-graph file (used to speed up "
+                'ancestry checks) whenever the master branch moves '
+                '(default: true)')
+
     _schema = [
-        Table('merge_store', key='target')[
+        Table('merge_store', key=('target', 'base'))[
             Column('base'),
             Column('target'),
-            Column('tmp')
+            Column('tmp'),
+            Column('time', type='int')
+        ],
+        Table('merge_queue', key=('target', 'base'))[
+            Column('target'),
+            Column('base'),
+            Column('priority', type='int'),
+            Column('time', type='int'),
+            Column('worker'),
+            Column('started', type='int'),
+            Column('attempts', type='int'),
+            Index(('priority', 'time'))
+        ],
+        Table('merge_commit_index', key='parent')[
+            Column('parent'),
+            Column('merge_commit')
         ]
     ]
 
-    _schema_version = 1
+    _schema_version = 5
+
+    _cache_touch_interval = 60
+    """
+    Minimum number of seconds between updates of the last use time of a
+    cached merge.
+    """
 
     def __init__(self):
         super(GitMerger, self).__init__()
@@ -56,9 +182,21 @@ class GitMerger(GitBase, GenericTableProvider):
 
         self._signature = pygit2.Signature(m.group(1), m.group(2))
 
+        m = _signature_re.match(self.release_manager_signature)
+        if not m:
+            raise TracError(
+                '[sage_trac]/release_manager_signature in trac.ini must be '
+                'in the "Name <email@example.com>" format')
+
+        self._release_signature = pygit2.Signature(m.group(1), m.group(2))
+
     def peek_merge(self, commit, base_branch=None):
         """
         See if the given commit already has a cached merge result.
+
+        Merges of the same commit are cached for up to ``merge_cache_bases``
+        different bases, so alternating between base branches does not
+        evict previously computed merges.
         """
 
         if not base_branch:
@@ -86,58 +224,413 @@ class GitMerger(GitBase, GenericTableProvider):
             self._set_cache(commit, base, ret)
         return ret
 
-    def _get_cache(self, commit, base=None):
-        with self.env.db_query as query:
-            cached = list(query("""
-                SELECT base, tmp FROM "merge_store" WHERE target=%s
-                """, (commit.hex,)))
+    def queue_merge(self, commit, base_branch=None, priority=0):
+        """
+        Queue a merge of the given commit to be computed by the background
+        workers.
+
+        A merge that is already queued for the same commit and base branch is
+        not queued twice, though its priority is raised if necessary.
+        """
+
+        if not base_branch:
+            base_branch = self.master_branch
+
+        try:
+            with self.env.db_transaction as db:
+                for queued_priority, in db("""
+                        SELECT priority FROM merge_queue
+                        WHERE target=%s AND base=%s
+                        """, (commit.hex, base_branch)):
+                    if queued_priority < priority:
+                        db("""
+                            UPDATE merge_queue SET priority=%s
+                            WHERE target=%s AND base=%s
+                            """, (priority, commit.hex, base_branch))
+                    break
+                else:
+                    db("""
+                        INSERT INTO merge_queue
+                        (target, base, priority, time)
+                        VALUES (%s, %s, %s, %s)
+                        """, (commit.hex, base_branch, priority,
+                              int(time.time())))
+        except self.env.db_exc.IntegrityError:
+            # Another process queued the same merge concurrently
+            pass
+
+    def process_merge_queue(self, once=False, warm=False):
+        """
+        Compute queued merges using a pool of ``merge_workers`` worker
+        processes.
+
+        Runs until interrupted, or if ``once`` is True until the queue is
+        empty.  If ``warm`` is True the merge cache is also warmed every
+        ``merge_warm_interval`` seconds (see `warm_merge_cache`).
+        """
 
-            if not cached:
-                return None
+        pool = WorkerPool(self, self.merge_workers)
+        # The results of jobs sent to the pool, with their deadlines and
+        # arguments
+        pending = []
+        last_warm = 0
+        graph_tip = None
+
+        try:
+            while True:
+                now = time.time()
+                pending = [(result, deadline, job)
+                           for result, deadline, job in pending
+                           if not result.ready()]
+                if any(deadline < now for _, deadline, _ in pending):
+                    # The result of a job whose worker died never becomes
+                    # ready, and a hung worker never finishes; replace the
+                    # pool rather than losing its slots for good
+                    pool.terminate()
+                    pool = WorkerPool(self, self.merge_workers)
+                    self._abandon_merge_jobs(pending, now)
+                    pending = []
+
+                # Jobs claimed by other processes that died or hung are
+                # released on every poll, so that they are picked up again
+                # while running as a daemon
+                self._release_stale_merge_jobs()
+
+                if warm and time.time() - last_warm >= self.warm_interval:
+                    master = self.master
+                    if (self.write_commit_graph_on_warm and
+                            master is not None and master.hex != graph_tip):
+                        self.write_commit_graph()
+                        graph_tip = master.hex
+                    self.update_merge_index()
+                    self.warm_merge_cache()
+                    last_warm = time.time()
+
+                jobs = self._claim_merge_jobs(
+                        self.merge_workers - len(pending))
+                deadline = time.time() + self.merge_job_timeout
+                for job in jobs:
+                    pending.append((pool.apply_async('run_merge_job', job),
+                                    deadline, job))
+
+                if jobs:
+                    continue
+                elif once and not pending:
+                    break
+
+                time.sleep(self.merge_poll_interval)
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+
+    def warm_merge_cache(self, force=False):
+        """
+        Queue merges for all tickets in one of the ``merge_warm_statuses``
+        with a branch if the master branch has moved since the last time this
+        was run (or unconditionally if ``force`` is True).
+
+        Merges are queued in order of ticket priority, and then most recently
+        changed tickets first.  Returns the number of merges queued.
+        """
 
-            if base is None:
-                return None
+        master = self.master
+        if master is None:
+            return 0
 
-            cached_base, cached_tmp = cached[0]
+        if not force and self._get_system_value(self._warm_tip_key) == \
+                master.hex:
+            return 0
 
-            if cached_tmp in GIT_SPECIAL_MERGES:
-                cached_obj = cached_tmp
+        statuses = self.warm_statuses
+        if not statuses:
+            return 0
+
+        count = 0
+        with self.env.db_query as db:
+            tickets = db("""
+                SELECT t.id, b.value, bb.value FROM ticket t
+                INNER JOIN ticket_custom b
+                    ON b.ticket=t.id AND b.name='branch'
+                LEFT OUTER JOIN ticket_custom bb
+                    ON bb.ticket=t.id AND bb.name='base_branch'
+                LEFT OUTER JOIN enum p
+                    ON p.type='priority' AND p.name=t.priority
+                WHERE t.status IN (%s) AND b.value<>''
+                ORDER BY %s, t.changetime DESC
+                """ % (','.join(['%s'] * len(statuses)),
+                       db.cast('p.value', 'int')), statuses)
+
+        for rank, (ticket_id, branch, base_branch) in enumerate(tickets):
+            try:
+                commit = self.generic_lookup(branch.strip())[1]
+            except (KeyError, ValueError):
+                continue
+
+            if not isinstance(commit, pygit2.Commit):
+                continue
+
+            # Background merges always have lower priority than interactive
+            # ones
+            self.queue_merge(commit, (base_branch or '').strip(),
+                             priority=-1 - rank)
+            count += 1
+
+        self._set_system_value(self._warm_tip_key, master.hex)
+        self.log.info('Queued %d merges to warm the merge cache for %s '
+                      'at %s', count, self.master_branch, master.hex)
+        return count
+
+    def _get_system_value(self, key):
+        for value, in self.env.db_query("""
+                SELECT value FROM system WHERE name=%s
+                """, (key,)):
+            return value
+
+    def _set_system_value(self, key, value):
+        with self.env.db_transaction as db:
+            db("DELETE FROM system WHERE name=%s", (key,))
+            db("INSERT INTO system (name, value) VALUES (%s, %s)",
+               (key, value))
+
+    def run_merge_job(self, commit_hex, base_branch):
+        """
+        Compute a merge claimed from the merge queue and remove it from the
+        queue; this is run in the worker processes.
+
+        A merge failing with an unexpected error (merge conflicts are
+        cached as failed merges by `get_merge`) is released to be tried
+        again, up to ``merge_max_attempts`` times, after which it is
+        recorded as a failed merge.
+        """
+
+        try:
+            commit = self._git.get(commit_hex)
+            if isinstance(commit, pygit2.Commit):
+                self.get_merge(commit, base_branch=base_branch)
+            else:
+                self.log.warn('Queued merge of %s ignored; it is not the '
+                              'hash of a known commit', commit_hex)
+        except Exception as exc:
+            self.log.error('Failed to compute queued merge of %s into %s: '
+                           '%s', commit_hex, base_branch,
+                           exception_to_unicode(exc, True))
+            if self._retry_merge_job(commit_hex, base_branch):
+                return
+
+        with self.env.db_transaction as db:
+            db("DELETE FROM merge_queue WHERE target=%s AND base=%s",
+               (commit_hex, base_branch))
+
+    def _retry_merge_job(self, commit_hex, base_branch):
+        """
+        Release a failed merge job to be tried again and return True, or
+        if it has been tried ``merge_max_attempts`` times, cache it as a
+        failed merge and return False.
+        """
+
+        with self.env.db_transaction as db:
+            for attempts, in db("""
+                    SELECT attempts FROM merge_queue
+                    WHERE target=%s AND base=%s
+                    """, (commit_hex, base_branch)):
+                attempts = (attempts or 0) + 1
+                if attempts < self.merge_max_attempts:
+                    # Requeued behind other merges of the same priority
+                    db("""
+                        UPDATE merge_queue
+                        SET worker=NULL, started=NULL, attempts=%s, time=%s
+                        WHERE target=%s AND base=%s
+                        """, (attempts, int(time.time()), commit_hex,
+                              base_branch))
+                    return True
+
+        try:
+            base = self.generic_lookup(base_branch)[1]
+            self._set_cache(self._git[commit_hex], base, GIT_FAILED_MERGE)
+        except Exception as exc:
+            self.log.error('Failed to record merge of %s into %s as '
+                           'failed: %s', commit_hex, base_branch,
+                           exception_to_unicode(exc))
+
+        return False
+
+    def _claim_merge_jobs(self, limit):
+        if limit <= 0:
+            return []
+
+        claimed = []
+        me = worker_id()
+
+        for target, base in self.env.db_query("""
+                SELECT target, base FROM merge_queue
+                WHERE worker IS NULL
+                ORDER BY priority DESC, time
+                LIMIT %s""", (limit,)):
+            with self.env.db_transaction as db:
+                cursor = db.cursor()
+                cursor.execute("""
+                    UPDATE merge_queue SET worker=%s, started=%s
+                    WHERE target=%s AND base=%s AND worker IS NULL
+                    """, (me, int(time.time()), target, base))
+                if cursor.rowcount == 1:
+                    claimed.append((target, base))
+
+        return claimed
+
+    def _abandon_merge_jobs(self, pending, now):
+        """
+        Release the claimed merge jobs of a terminated worker pool, given as
+        ``(result, deadline, (commit_hex, base_branch))``.  Jobs past their
+        deadline count as failed attempts; the others are simply released.
+        """
+
+        me = worker_id()
+        for _, deadline, (commit_hex, base_branch) in pending:
+            if deadline < now:
+                self.log.error('Merge of %s into %s did not finish within '
+                               '%d seconds; restarting the merge workers',
+                               commit_hex, base_branch,
+                               self.merge_job_timeout)
+                if self._retry_merge_job(commit_hex, base_branch):
+                    continue
+                with self.env.db_transaction as db:
+                    db("""
+                        DELETE FROM merge_queue WHERE target=%s AND base=%s
+                        """, (commit_hex, base_branch))
             else:
-                # Perhaps the cached merge commit no longer exists (e.g.
-                # because has no parents maybe it got purged during garbage
-                # collection on the repo), so we check that it still exists in
-                # the repo and if not we just invalidate the cache in this case
-                # and generate a new merge
-                cached_obj = self._git.get(cached_tmp)
-
-            if cached_base != base.hex or cached_obj is None:
-                with self.env.db_transaction as tx:
-                    tx("DELETE FROM merge_store WHERE target=%s",
-                       (commit.hex,))
-                return None
+                with self.env.db_transaction as db:
+                    db("""
+                        UPDATE merge_queue SET worker=NULL, started=NULL
+                        WHERE target=%s AND base=%s AND worker=%s
+                        """, (commit_hex, base_branch, me))
+
+    def _release_stale_merge_jobs(self):
+        with self.env.db_transaction as db:
+            db("""
+                UPDATE merge_queue SET worker=NULL, started=NULL
+                WHERE worker IS NOT NULL AND started<%s
+                """, (int(time.time()) - self.merge_job_timeout,))
+
+    def _get_cache(self, commit, base=None):
+        if base is None:
+            return None
+
+        cached = self.env.db_query("""
+            SELECT tmp, time FROM "merge_store" WHERE target=%s AND base=%s
+            """, (commit.hex, base.hex))
+
+        if not cached:
+            return None
+
+        cached_tmp, cached_time = cached[0]
+
+        if cached_tmp in GIT_SPECIAL_MERGES:
+            cached_obj = cached_tmp
+        else:
+            # Perhaps the cached merge commit no longer exists (e.g.
+            # because has no parents maybe it got purged during garbage
+            # collection on the repo), so we check that it still exists in
+            # the repo and if not we just invalidate the cache in this case
+            # and generate a new merge
+            cached_obj = self._git.get(cached_tmp)
+
+        now = int(time.time())
+        if cached_obj is None:
+            with self.env.db_transaction as db:
+                db("DELETE FROM merge_store WHERE target=%s AND base=%s",
+                   (commit.hex, base.hex))
+            return None
+        elif now - (cached_time or 0) > self._cache_touch_interval:
+            # Record the use of this base for LRU eviction; this is done
+            # sparingly to avoid a write for every read of the cache
+            with self.env.db_transaction as db:
+                db("""
+                    UPDATE merge_store SET time=%s
+                    WHERE target=%s AND base=%s
+                    """, (now, commit.hex, base.hex))
 
         return cached_obj
 
     def _set_cache(self, commit, base, tmp):
-        with self.env.db_transaction as db:
-            cursor = db.cursor()
-            cursor.execute('DELETE FROM "merge_store" WHERE target=%s',
-                           (commit.hex,))
+        if tmp not in GIT_SPECIAL_MERGES:
+            tmp = tmp.hex
 
         with self.env.db_transaction as db:
-            if tmp not in GIT_SPECIAL_MERGES:
-                tmp = tmp.hex
-            cursor = db.cursor()
-            cursor.execute('INSERT INTO "merge_store" VALUES (%s, %s, %s)',
-                    (base.hex, commit.hex, tmp))
+            db('DELETE FROM "merge_store" WHERE target=%s AND base=%s',
+               (commit.hex, base.hex))
+            db('INSERT INTO "merge_store" VALUES (%s, %s, %s, %s)',
+               (base.hex, commit.hex, tmp, int(time.time())))
+
+            # Evict the least recently used bases for this commit
+            bases = db("""
+                SELECT base FROM "merge_store" WHERE target=%s
+                ORDER BY time DESC
+                """, (commit.hex,))
+            for old_base, in bases[max(self.merge_cache_bases, 1):]:
+                db('DELETE FROM "merge_store" WHERE target=%s AND base=%s',
+                   (commit.hex, old_base))
 
     def _merge(self, commit, base_branch):
+        if self.merge_mode == 'memory' and hasattr(self._git, 'merge_trees'):
+            return self._merge_in_memory(commit, base_branch)
+
+        return self._merge_clone(commit, base_branch)
+
+    def _merge_in_memory(self, commit, base_branch):
+        """
+        Merge the given commit into ``base_branch`` without a working tree.
+
+        The base and the commit are merged into an in-memory index against
+        the bare repository itself, so the only objects written are those of
+        the merge result.  Like ``git merge``, when they have several merge
+        bases (criss-cross merges) these are first merged recursively into
+        a virtual merge base; pygit2 versions without ``merge_commits``
+        merge against a single merge base instead.
+        """
+
+        base = self.generic_lookup(base_branch)[1]
+        merge_base = self._git.merge_base(base.oid, commit.oid)
+
+        if merge_base is None:
+            # Unrelated histories; git itself refuses to merge these by
+            # default
+            raise pygit2.GitError('%s and %s do not share any history' %
+                                  (commit.hex, base.hex))
+        elif merge_base == commit.oid:
+            return GIT_UPTODATE
+        elif merge_base == base.oid:
+            return GIT_FASTFORWARD
+
+        if hasattr(self._git, 'merge_commits'):
+            index = self._git.merge_commits(base, commit)
+        else:
+            index = self._git.merge_trees(self._git[merge_base].tree,
+                                          base.tree, commit.tree)
+        if index.conflicts is not None:
+            return GIT_FAILED_MERGE
+
+        merge_tree = index.write_tree(self._git)
+
+        return self._git.get(
+                self._git.create_commit(
+                    None,  # don't update any refs
+                    self._signature,  # author
+                    self._signature,  # committer
+                    'Temporary merge of %s into %s' % (commit.hex, base.hex),  # merge message
+                    merge_tree,  # commit's tree
+                    [base.oid, commit.oid],  # parents
+                ))
+
+    def _merge_clone(self, commit, base_branch):
         tmpdir = tempfile.mkdtemp()
 
         try:
             # libgit2/pygit2 are ridiculously slow when cloning local paths
             ret, out = run_git('clone', self.git_dir, tmpdir,
-                               '--branch=%s' % base_branch)
+                               '--branch=%s' % base_branch,
+                               timeout=self.git_timeout)
             if ret != 0:
                 raise TracError('Failure to create temporary git repository '
                                 'clone for merge preview of %s: %s' %
@@ -153,11 +646,16 @@ class GitMerger(GitBase, GenericTableProvider):
                 # non-trivial merge, so run merge algorithm
                 repo.merge(commit.oid)
 
-                # record the files that changed
+                # record the files that changed: the merged tree can only
+                # differ from the base in files changed on the branch since
+                # it forked off the base (or, for unrelated histories, in
+                # files that differ between the two)
+                fork_point = (self._git.merge_base(repo.head.target,
+                                                   commit.oid) or
+                              repo.head.target)
                 changed = set()
-                for file, s in repo.status().items():
-                    if s != pygit2.GIT_STATUS_INDEX_DELETED:
-                        changed.add(file)
+                for file in self.changed_paths(fork_point, commit):
+                    changed.add(file)
                     file = os.path.dirname(file)
                     while file:
                         changed.add(file)
@@ -200,28 +698,148 @@ class GitMerger(GitBase, GenericTableProvider):
         return ret
 
     def find_base_and_merge(self, branch, base=None):
+        """
+        Find the release manager merge that merged the given branch into the
+        base (by default the master branch), if any.
+
+        Returns the base and the merge commit, or ``(None, None)`` if the
+        branch was not merged by the release manager.  For the master branch
+        this is looked up in the merge_commit_index table once it has been
+        built (by ``merger reindex`` or ``merger warm --daemon``), and only
+        commits added to the master branch since it was last updated are
+        walked; otherwise the history of the base is walked.  The index is
+        never written to here.
+        """
+
+        master = self.master
         if base is None:
-            base = self.master
+            base = master
+
+        index_tip = None
+        if master is not None and base.oid == master.oid:
+            index_tip = self._merge_index_tip(master)
+
+        if index_tip is not None:
+            for merge_hex, in self.env.db_query("""
+                    SELECT merge_commit FROM merge_commit_index
+                    WHERE parent=%s""", (branch.hex,)):
+                commit = self._git.get(merge_hex)
+                if commit is not None:
+                    return self._merge_base_of(commit, branch, base), commit
+
+            if index_tip.oid == master.oid:
+                return None, None
+
+        if not self.is_ancestor(branch, base):
+            # Not merged at all; no need to walk the history of the base
+            return None, None
 
         walker = self._git.walk(base.oid,
                 pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_REVERSE)
         walker.hide(branch.oid)
+        if index_tip is not None:
+            walker.hide(index_tip.oid)
         for commit in walker:
             if (branch.oid in (p.oid for p in commit.parents) and
                     signature_eq(commit.author, self._release_signature)):
-                found_base = None
-                for p in commit.parents:
-                    if p.oid == branch.oid:
-                        pass
-                    elif found_base is None:
-                        found_base = p.oid
-                    else:
-                        found_base = self._git.merge_base(found_base, p.oid)
-                if found_base is not None:
-                    found_base = self._git.get(base.oid)
-                return found_base, commit
+                return self._merge_base_of(commit, branch, base), commit
         return None, None
 
+    def _merge_index_tip(self, master):
+        """
+        Return the commit of the master branch up to which the
+        merge_commit_index table is up to date, or `None` if it was never
+        built or the master branch was since rewound.
+        """
+
+        tip_hex = self._get_system_value(self._merge_index_tip_key)
+        if tip_hex is None:
+            return None
+
+        tip = self._git.get(tip_hex)
+        if tip is None or not self.is_ancestor(tip, master):
+            return None
+
+        return tip
+
+    def _merge_base_of(self, commit, branch, base):
+        found_base = None
+        for p in commit.parents:
+            if p.oid == branch.oid:
+                pass
+            elif found_base is None:
+                found_base = p.oid
+            else:
+                found_base = self._git.merge_base(found_base, p.oid)
+        if found_base is not None:
+            found_base = self._git.get(base.oid)
+        return found_base
+
+    def update_merge_index(self, rebuild=False):
+        """
+        Add the release manager merges made on the master branch since the
+        last update to the merge_commit_index table, which maps each parent
+        of those merges to the (oldest) merge that has it as a parent.
+
+        The index is rebuilt from scratch if ``rebuild`` is True, or if the
+        master branch was rewound.  Returns False if the index could not be
+        updated.
+        """
+
+        master = self.master
+        if master is None:
+            return False
+
+        last_tip = None if rebuild else \
+                self._get_system_value(self._merge_index_tip_key)
+        if last_tip == master.hex:
+            return True
+
+        walker = self._git.walk(master.oid,
+                pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_REVERSE)
+
+        if last_tip is not None:
+            last_commit = self._git.get(last_tip)
+            if (last_commit is not None and
+                    self.is_ancestor(last_commit, master)):
+                walker.hide(last_commit.oid)
+            else:
+                last_tip = None
+
+        merges = {}
+        for commit in walker:
+            if (len(commit.parents) > 1 and
+                    signature_eq(commit.author, self._release_signature)):
+                for parent in commit.parents:
+                    merges.setdefault(parent.hex, commit.hex)
+
+        try:
+            with self.env.db_transaction as db:
+                if last_tip is None:
+                    db("DELETE FROM merge_commit_index")
+                else:
+                    for chunk in _chunks(merges):
+                        for parent, in db("""
+                                SELECT parent FROM merge_commit_index
+                                WHERE parent IN (%s)
+                                """ % ','.join(['%s'] * len(chunk)), chunk):
+                            # Keep the oldest merge
+                            del merges[parent]
+
+                for parent, merge_hex in merges.items():
+                    db("""
+                        INSERT INTO merge_commit_index (parent, merge_commit)
+                        VALUES (%s, %s)""", (parent, merge_hex))
+
+                self._set_system_value(self._merge_index_tip_key, master.hex)
+        except self.env.db_exc.IntegrityError:
+            # Another process updated the index concurrently
+            pass
+
+        self.log.debug('Added %d merges up to %s to the merge index',
+                       len(merges), master.hex)
+        return True
+
     def get_merge_url(self, req, branch, merge_result=None, base=None):
         """
         Return the appropriate URL for a merge preview (or lack thereof),
@@ -280,12 +898,158 @@ class GitMerger(GitBase, GenericTableProvider):
             return merge
         return merge.hex
 
+    def getMerges(self, req, ticketnums, compute=False):
+        """
+        Return the merges of the branches of several tickets at once, as a
+        mapping of ticket numbers (as strings) to the same values returned by
+        ``getMerge``.
+
+        Only merges already in the cache are returned, unless ``compute`` is
+        true, in which case missing merges are queued for the merge workers
+        and returned as ``GIT_PENDING_MERGE``, so they can be asked for again
+        later.  Tickets that do not exist or that may not be viewed are
+        omitted.
+        """
+
+        ticket_ids = set()
+        for ticketnum in ticketnums:
+            try:
+                ticket_ids.add(int(ticketnum))
+            except (TypeError, ValueError):
+                continue
+
+        fields = dict((ticket_id, {}) for ticket_id in ticket_ids)
+        with self.env.db_query as db:
+            for chunk in _chunks(ticket_ids):
+                for ticket_id, name, value in db("""
+                        SELECT t.id, c.name, c.value FROM ticket t
+                        LEFT OUTER JOIN ticket_custom c
+                            ON c.ticket=t.id AND
+                               c.name IN ('branch', 'base_branch')
+                        WHERE t.id IN (%s)
+                        """ % ','.join(['%s'] * len(chunk)), chunk):
+                    fields[ticket_id]['exists'] = True
+                    if name:
+                        fields[ticket_id][name] = (value or '').strip()
+
+        results = {}
+        # Maps (commit, base) hex pairs to the tickets having that merge
+        merges = {}
+        bases = {}
+
+        for ticket_id, values in fields.items():
+            if (not values.get('exists') or
+                    'TICKET_VIEW' not in req.perm('ticket', ticket_id)):
+                continue
+
+            results[str(ticket_id)] = ''
+
+            base_branch = values.get('base_branch') or self.master_branch
+            try:
+                commit = self.generic_lookup(values.get('branch', ''))[1]
+                if base_branch not in bases:
+                    bases[base_branch] = self.generic_lookup(base_branch)[1]
+            except (KeyError, ValueError):
+                continue
+
+            key = (commit.hex, bases[base_branch].hex)
+            merges.setdefault(key, (base_branch, []))[1].append(ticket_id)
+
+        missing = set(merges)
+        with self.env.db_query as db:
+            for chunk in _chunks(set(commit for commit, _ in merges)):
+                for base, target, tmp in db("""
+                        SELECT base, target, tmp FROM "merge_store"
+                        WHERE target IN (%s)
+                        """ % ','.join(['%s'] * len(chunk)), chunk):
+                    if (target, base) not in merges:
+                        continue
+                    elif (tmp not in GIT_SPECIAL_MERGES and
+                            self.object_info(tmp) is None):
+                        # The merge commit was purged from the repository
+                        continue
+
+                    for ticket_id in merges[(target, base)][1]:
+                        results[str(ticket_id)] = tmp
+                    missing.discard((target, base))
+
+        for key in missing:
+            base_branch, ticket_ids = merges[key]
+            if compute:
+                self.queue_merge(self._git[key[0]], base_branch)
+
+            for ticket_id in ticket_ids:
+                if compute:
+                    results[str(ticket_id)] = GIT_PENDING_MERGE
+                else:
+                    del results[str(ticket_id)]
+
+        return results
+
+    # IAdminCommandProvider methods
+    def get_admin_commands(self):
+        yield ('merger work', '[--once]',
+               'Compute queued merge previews using a pool of worker '
+               'processes; with --once, exit when the queue is empty',
+               None, self._do_work)
+        yield ('merger warm', '[--force|--daemon]',
+               'Queue and compute merge previews for tickets in review if '
+               'the master branch has moved since the last run (always with '
+               '--force); with --daemon, keep running, checking for new '
+               'tips of the master branch and processing the merge queue',
+               None, self._do_warm)
+        yield ('merger commit-graph', '',
+               "Write the repository's commit-graph file, which speeds up "
+               'ancestry checks between commits',
+               None, self._do_commit_graph)
+        yield ('merger reindex', '',
+               'Rebuild the index of release manager merges into the master '
+               'branch used to find the merge of already merged branches',
+               None, self._do_reindex)
+
+    def _do_work(self, *args):
+        once = '--once' in args
+        printout('Processing the merge queue with %d workers' %
+                 self.merge_workers)
+        self.process_merge_queue(once=once)
+
+    def _do_commit_graph(self):
+        if self.write_commit_graph():
+            printout('Wrote the commit-graph of %s' % self.git_dir)
+        else:
+            raise AdminCommandError('Writing the commit-graph of %s failed' %
+                                    self.git_dir)
+
+    def _do_reindex(self):
+        self.update_merge_index(rebuild=True)
+        printout('Rebuilt the index of release manager merges')
+
+    def _do_warm(self, *args):
+        if '--daemon' in args:
+            printout('Warming the merge cache whenever %s moves' %
+                     self.master_branch)
+            self.process_merge_queue(warm=True)
+            return
+
+        count = self.warm_merge_cache(force='--force' in args)
+        printout('Queued %d merges' % count)
+        if count:
+            self.process_merge_queue(once=True)
+
+    # ITemplateProvider methods
+    def get_templates_dirs(self):
+        return [pkg_resources.resource_filename('sage_trac', 'templates')]
+
+    def get_htdocs_dirs(self):
+        return []
+
     # IXMLRPCHandler methods
     def xmlrpc_namespace(self):
         return 'merger'
 
     def xmlrpc_methods(self):
         yield (None, ((str, int),), self.getMerge)
+        yield (None, ((dict, list), (dict, list, bool)), self.getMerges)
 
     # IRequestHandler methods
     def match_request(self, req):
@@ -298,7 +1062,9 @@ class GitMerger(GitBase, GenericTableProvider):
         # Generate the merge preview for the specified commit and
         # redirect either directly to the merge preview if successful, or
         # back to the previous page if unsuccessful
-        referer = req.get_header('Referer')
+        referer = req.args.get('referer')
+        if not (referer and referer.startswith(req.abs_href())):
+            referer = req.get_header('Referer')
         if not referer:
             referer = req.base_path
 
@@ -307,9 +1073,23 @@ class GitMerger(GitBase, GenericTableProvider):
 
         commit_hex = req.args['commit']
 
-        try:
-            commit = self._git.get(commit_hex)
-        except ValueError:
+        if not _sha1_re.match(commit_hex):
+            raise TracError('%s is not a commit SHA-1' % commit_hex)
+
+        commit_hex = commit_hex.lower()
+        if len(commit_hex) < 40:
+            # Resolved as an object prefix only, never as a ref name
+            try:
+                obj = self._git.get(commit_hex)
+            except ValueError:
+                obj = None
+            if obj is not None:
+                commit_hex = obj.hex
+
+        info = self.object_info(commit_hex)
+        if info is not None and info[1] == 'commit':
+            commit = self._git.get(info[0])
+        else:
             commit = None
 
         if not isinstance(commit, pygit2.Commit):
@@ -326,7 +1106,15 @@ class GitMerger(GitBase, GenericTableProvider):
         else:
             base_branch = base = None
 
-        merge = self.get_merge(commit, base_branch=base_branch)
+        if self.merge_in_background:
+            merge = self.peek_merge(commit, base_branch=base_branch)
+            if merge is None:
+                self.queue_merge(commit, base_branch,
+                                 priority=MERGE_PRIORITY_INTERACTIVE)
+                return self._render_pending(req, commit, base_branch,
+                                            referer)
+        else:
+            merge = self.get_merge(commit, base_branch=base_branch)
 
         if merge == GIT_FAILED_MERGE:
             add_warning(req, 'Merge failed for %s' % commit_hex)
@@ -340,3 +1128,54 @@ class GitMerger(GitBase, GenericTableProvider):
             req.redirect(referer)
         else:
             req.redirect(merge_url)
+
+    def _render_pending(self, req, commit, base_branch, referer):
+        args = {'referer': referer}
+        if base_branch:
+            args['base'] = base_branch
+
+        data = {
+            'commit': commit.hex,
+            'base_branch': base_branch or self.master_branch,
+            'poll_interval': self.merge_poll_interval,
+            'poll_url': req.href('git-merger', commit.hex, **args)
+        }
+
+        return 'git_merger_pending.html', data, None
+
+    # GenericTableProvider methods
+    def _upgrade_schema(self, db, prev_version):
+        if prev_version is not False and prev_version < 2:
+            self._create_tables(db, ['merge_queue'])
+
+        # Unversioned installs of this plugin may also have the old
+        # merge_store table keyed on target alone; it is only rebuilt if it
+        # still lacks the time column, since this may already have been
+        # done by the upgrade of another subclass of GitMerger
+        if ((prev_version is False or prev_version < 3) and
+                'time' not in self._get_column_names(db, 'merge_store')):
+            rows = db('SELECT base, target, tmp FROM "merge_store"')
+            db('DROP TABLE "merge_store"')
+            self._create_tables(db, ['merge_store'])
+            now = int(time.time())
+            for base, target, tmp in rows:
+                db('INSERT INTO "merge_store" VALUES (%s, %s, %s, %s)',
+                   (base, target, tmp, now))
+
+        if prev_version is not False and prev_version < 4:
+            self._create_tables(db, ['merge_commit_index'])
+
+        # As for merge_store, another subclass may already have done this
+        if (prev_version is not False and prev_version < 5 and
+                'attempts' not in self._get_column_names(db, 'merge_queue')):
+            rows = db("""
+                SELECT target, base, priority, time, worker, started
+                FROM merge_queue""")
+            db('DROP TABLE "merge_queue"')
+            self._create_tables(db, ['merge_queue'])
+            for row in rows:
+                db("""
+                    INSERT INTO merge_queue
+                        (target, base, priority, time, worker, started,
+                         attempts)
+                    VALUES (%s, %s, %s, %s, %s, %s, 0)""", row)
@@ -1,32 +1,46 @@
 import json
+import os.path
 import re
+import time
 
+from multiprocessing.pool import ThreadPool
 from pprint import pformat
 
-import requests
-import pygit2
-
-from trac.config import Option, IntOption
-from trac.core import implements
+from trac.admin.api import IAdminCommandProvider
+from trac.config import ChoiceOption, Option, IntOption, PathOption
+from trac.core import implements, TracError
+from trac.db.schema import Table, Column, Index
 from trac.notification.api import NotificationSystem
 from trac.ticket.api import ITicketChangeListener
 from trac.ticket.model import Ticket
 from trac.ticket.notification import TicketChangeEvent
-from trac.util.text import exception_to_unicode
+from trac.util.text import exception_to_unicode, printout
 from trac.web.api import IRequestHandler
 
-from .common import GitBase, run_git
+from .common import (GitBase, GenericTableProvider, WorkerPool, _chunks,
+                     run_git, worker_id)
+from .fetch_scheduler import FetchScheduler
+from .gitlab_api import GitlabApiError, GitlabClient
 from .token import TokenAuthenticator
 
 
-class GitlabWebhook(GitBase):
+# Matches the final progress line for objects received by git fetch, e.g.
+# "Receiving objects: 100% (3/3), 1.20 KiB | 1.20 MiB/s, done."
+_fetch_received_re = re.compile(
+    r'(?:Receiving|Unpacking) objects: 100% \((\d+)/\d+\), '
+    r'([\d.]+ (?:bytes|[KMG]iB))')
+
+
+class GitlabWebhook(GitBase, GenericTableProvider):
     """
     Component that handles webhook API requests from GitLab.
 
-    Currently just handles merge request events.
+    Currently just handles merge request events.  Events are only validated
+    and stored in the ``gitlab_event_queue`` table by the web request; they
+    are processed by workers run with ``trac-admin <env> gitlab work``.
     """
 
-    implements(IRequestHandler, ITicketChangeListener)
+    implements(IRequestHandler, ITicketChangeListener, IAdminCommandProvider)
 
     endpoint = Option('sage_trac', 'gitlab_webhook_endpoint',
         '/gitlab-hook', doc='string or regular expression to match with '
@@ -64,10 +78,111 @@ class GitlabWebhook(GitBase):
                 'that is added to a ticket when commits are added to a '
                 'merge request')
 
+    workers = IntOption('sage_trac', 'gitlab_webhook_workers', 2,
+            doc='number of worker processes used by `trac-admin <env> '
+                'gitlab work` to process queued webhook events; events for '
+                'the same merge request are always processed one at a time, '
+                'in the order they were received (default: 2)')
+
+    poll_interval = IntOption('sage_trac', 'gitlab_webhook_poll_interval', 2,
+            doc='number of seconds between checks of the webhook event '
+                'queue by idle workers (default: 2)')
+
+    max_attempts = IntOption('sage_trac', 'gitlab_webhook_max_attempts', 5,
+            doc='number of times processing of a webhook event, or a call '
+                'to the GitLab API, is attempted before it is given up on '
+                '(default: 5)')
+
+    retry_delay = IntOption('sage_trac', 'gitlab_webhook_retry_delay', 30,
+            doc='number of seconds before a webhook event that failed to '
+                'be processed, or a failed call to the GitLab API, is '
+                'retried; the delay is doubled after each failed attempt '
+                '(default: 30)')
+
+    fetch_mode = ChoiceOption('sage_trac', 'gitlab_fetch_mode',
+            ['negotiated', 'plain'],
+            doc='how merge request branches are fetched from forks: '
+                '"negotiated" (the default) fetches over git protocol v2, '
+                'telling the fork that we already have the tip of the '
+                'master branch and the previously synced commit of the '
+                'merge request, so that only new objects are sent; "plain" '
+                'runs a plain `git fetch`')
+
+    max_fetches = IntOption('sage_trac', 'gitlab_max_fetches', 4,
+            doc='maximum number of merge request branches fetched from '
+                'forks at once, across all processes (default: 4)')
+
+    max_fetches_per_host = IntOption('sage_trac',
+            'gitlab_max_fetches_per_host', 2,
+            doc='maximum number of merge request branches fetched at once '
+                'from the same host (default: 2)')
+
+    fetch_lock_dir = PathOption('sage_trac', 'gitlab_fetch_lock_dir', '',
+            doc='directory holding the lock files used to limit concurrent '
+                'fetches; must be shared by all processes fetching into the '
+                'repository (default: the fetch-locks directory of the Trac '
+                'environment)')
+
+    api_concurrency = IntOption('sage_trac', 'gitlab_api_concurrency', 4,
+            doc='maximum number of concurrent calls to the GitLab API made '
+                'by `trac-admin <env> gitlab work` (default: 4)')
+
+    job_timeout = IntOption('sage_trac', 'gitlab_webhook_job_timeout', 600,
+            doc='number of seconds after which a webhook event claimed by '
+                'a worker that never finished it may be claimed by another '
+                'worker (default: 600)')
+
+    coalesce_window = IntOption('sage_trac',
+            'gitlab_webhook_coalesce_window', 10,
+            doc='number of seconds queued webhook events wait before being '
+                'processed; all events for the same merge request received '
+                'in the meantime are processed together as a single fetch '
+                'of its latest commit and a single ticket change '
+                '(default: 10)')
+
+    _schema = [
+        Table('gitlab_event_queue', key='id')[
+            Column('id', auto_increment=True),
+            Column('merge_request'),
+            Column('event'),
+            Column('time', type='int'),
+            Column('attempts', type='int'),
+            Column('next_attempt', type='int'),
+            Column('worker'),
+            Column('started', type='int'),
+            Index(['merge_request']),
+            Index(['next_attempt'])
+        ],
+        Table('gitlab_mr_ticket', key='merge_request')[
+            Column('merge_request'),
+            Column('ticket', type='int'),
+            Index(['ticket'])
+        ],
+        Table('gitlab_outbox', key='id')[
+            Column('id', auto_increment=True),
+            Column('merge_request'),
+            Column('action'),
+            Column('body'),
+            Column('time', type='int'),
+            Column('attempts', type='int'),
+            Column('next_attempt', type='int'),
+            Column('worker'),
+            Column('started', type='int'),
+            Index(['merge_request']),
+            Index(['next_attempt'])
+        ]
+    ]
+
+    _schema_version = 3
+
+    _gitlab_client = None
+    _fetch_scheduler = None
+
     _field_name = '_gitlab_webhook_merge_request'
     """
     The name of the hidden custom ticket field used to associate a ticket
-    with a merge request.
+    with a merge request.  Lookups go through the gitlab_mr_ticket table
+    instead, which is indexed both ways.
     """
 
     # IRequestHandler methods
@@ -79,7 +194,7 @@ class GitlabWebhook(GitBase):
     def process_request(self, req):
         # First check for the expected X-Gitlab-Event header
         event = req.get_header('X-Gitlab-Event')
-        if not event and event.lower() == 'merge request hook':
+        if not event or event.lower() != 'merge request hook':
             self.log.warn('GitLab webhook request event missing or '
                           'not handled: {}'.format(event))
             req.send_response(422)
@@ -96,6 +211,8 @@ class GitlabWebhook(GitBase):
 
         try:
             hook_data = json.load(req)
+            attrs = hook_data['object_attributes']
+            proj_mr_id = '{}:{}'.format(attrs['target']['id'], attrs['iid'])
         except Exception as exc:
             self.log.warn(
                 'Gitlab webhook failed to parse the JSON request '
@@ -105,10 +222,188 @@ class GitlabWebhook(GitBase):
         self.log.debug('GitLab webhook received event payload:\n' +
                 pformat(hook_data))
 
-        if hook_data['object_attributes']['state'] == 'closed':
+        if attrs.get('state') == 'closed':
             # Do not update tickets/branches for closed merged requests
             return req.send_no_content()
 
+        self.queue_event(proj_mr_id, hook_data)
+        req.send('', 'text/plain', 202)
+
+    # Event queue
+
+    def queue_event(self, proj_mr_id, hook_data):
+        """
+        Store a merge request event in the event queue to be processed by
+        `process_event_queue` once the ``coalesce_window`` has passed.
+        """
+
+        now = int(time.time())
+        with self.env.db_transaction as db:
+            db("""
+                INSERT INTO gitlab_event_queue
+                    (merge_request, event, time, attempts, next_attempt)
+                VALUES (%s, %s, %s, 0, %s)
+                """, (proj_mr_id, json.dumps(hook_data), now,
+                      now + self.coalesce_window))
+
+    def process_event_queue(self, once=False):
+        """
+        Process queued webhook events using a pool of ``workers`` worker
+        processes, and send queued calls to the GitLab API from up to
+        ``api_concurrency`` threads.
+
+        Runs until interrupted, or if ``once`` is True until there are no
+        more events or API calls ready to be processed (those waiting to be
+        retried are left in the queue).
+        """
+
+        pool = WorkerPool(self, self.workers)
+        threads = ThreadPool(self.api_concurrency)
+        # The results of events sent to the pool, with their deadlines and
+        # IDs
+        pending = []
+        sending = []
+
+        try:
+            while True:
+                now = time.time()
+                pending = [(result, deadline, event_id)
+                           for result, deadline, event_id in pending
+                           if not result.ready()]
+                if any(deadline < now for _, deadline, _ in pending):
+                    # The result of an event whose worker died never becomes
+                    # ready, and a hung worker never finishes; replace the
+                    # pool rather than losing its slots for good
+                    pool.terminate()
+                    pool = WorkerPool(self, self.workers)
+                    self._abandon_events(pending, now)
+                    pending = []
+
+                # Events and API calls claimed by other processes that died
+                # or hung are released on every poll; until then they would
+                # block all later events for the same merge request
+                self._release_stale_events()
+
+                jobs = self._claim_events(self.workers - len(pending))
+                deadline = time.time() + self.job_timeout
+                for event_id in jobs:
+                    pending.append((pool.apply_async('run_event_job',
+                                                     (event_id,)),
+                                    deadline, event_id))
+
+                sending = [result for result in sending
+                           if not result.ready()]
+                batches = self._claim_outbox(
+                        self.api_concurrency - len(sending))
+                for proj_mr_id in batches:
+                    sending.append(threads.apply_async(self._send_outbox,
+                                                       (proj_mr_id,)))
+
+                if jobs or batches:
+                    continue
+                elif once and not (pending or sending):
+                    break
+
+                time.sleep(self.poll_interval)
+        except:
+            pool.terminate()
+            threads.terminate()
+            raise
+        else:
+            pool.close()
+            threads.close()
+            threads.join()
+
+    def run_event_job(self, event_id):
+        """
+        Process an event claimed from the event queue, together with all
+        later events queued for the same merge request (see
+        `_coalesce_events`).
+
+        The events are removed from the queue if they were processed (or
+        have failed too many times), otherwise the claimed event is
+        scheduled to be retried; this is run in the worker processes.
+        """
+
+        rows = self.env.db_query("""
+                SELECT q.id, q.event, q.attempts FROM gitlab_event_queue q
+                INNER JOIN gitlab_event_queue c
+                    ON c.merge_request=q.merge_request
+                WHERE c.id=%s AND q.id>=%s
+                ORDER BY q.id
+                """, (event_id, event_id))
+        if not rows:
+            return
+
+        event_ids = [row[0] for row in rows]
+        attempts = (rows[0][2] or 0) + 1
+        last_attempt = attempts >= self.max_attempts
+
+        hook_data = self._coalesce_events([json.loads(row[1])
+                                           for row in rows])
+        if len(rows) > 1:
+            self.log.debug('Gitlab webhook coalesced {} queued events for '
+                           'merge request {}'.format(
+                               len(rows), hook_data['object_attributes']
+                                                   ['iid']))
+
+        try:
+            self.process_event(hook_data, last_attempt=last_attempt)
+        except Exception as exc:
+            if last_attempt:
+                self.log.error(
+                    'Gitlab webhook failed to process queued event {} '
+                    'after {} attempts; giving up: {}'.format(
+                        event_id, attempts, exception_to_unicode(exc, True)))
+            else:
+                delay = self.retry_delay * 2 ** (attempts - 1)
+                self.log.warn(
+                    'Gitlab webhook failed to process queued event {}; '
+                    'retrying in {} seconds: {}'.format(
+                        event_id, delay, exception_to_unicode(exc)))
+                with self.env.db_transaction as db:
+                    db("""
+                        UPDATE gitlab_event_queue
+                        SET attempts=%s, next_attempt=%s, worker=NULL,
+                            started=NULL
+                        WHERE id=%s
+                        """, (attempts, int(time.time()) + delay, event_id))
+                return
+
+        with self.env.db_transaction as db:
+            for chunk in _chunks(event_ids):
+                db("DELETE FROM gitlab_event_queue WHERE id IN (%s)" %
+                   ','.join(['%s'] * len(chunk)), chunk)
+
+    def _coalesce_events(self, events):
+        """
+        Combine successive events for the same merge request into one.
+
+        The newest event describes the current state of the merge request
+        (including its latest commit), so it is used as is, except that the
+        ``changes`` of all the events are combined so that e.g. a change to
+        the title in an earlier event is still applied to the ticket.
+        """
+
+        hook_data = dict(events[-1])
+        changes = {}
+        for event in events:
+            changes.update(event.get('changes') or {})
+
+        if changes:
+            hook_data['changes'] = changes
+
+        return hook_data
+
+    def process_event(self, hook_data, last_attempt=True):
+        """
+        Sync the branch and create or update the ticket for a merge request
+        event.
+
+        Raises an exception if the event should be retried; unless this is
+        the ``last_attempt``, that includes failing to fetch the branch.
+        """
+
         try:
             synced_branch = self._sync_branch(hook_data)
         except Exception as exc:
@@ -117,6 +412,9 @@ class GitlabWebhook(GitBase):
                 'branch: {}'.format(exception_to_unicode(exc, True)))
             synced_branch = False
 
+        if not synced_branch and not last_attempt:
+            raise TracError('failed to sync the downstream branch')
+
         try:
             self._create_or_update_ticket(hook_data, synced_branch)
         except Exception as exc:
@@ -124,8 +422,258 @@ class GitlabWebhook(GitBase):
                 'Gitlab webhook failed to create or update the '
                 'ticket for this merge request: {}'.format(
                     exception_to_unicode(exc, True)))
+            raise
+
+    def _claim_events(self, limit):
+        """
+        Claim up to ``limit`` events that are ready to be processed.
+
+        Only the oldest queued event of each merge request can be claimed,
+        so the events of a merge request are processed in order, and not
+        until the previous one has been processed (or given up on).
+        """
+
+        if limit <= 0:
+            return []
+
+        claimed = []
+        me = worker_id()
+        now = int(time.time())
+
+        for event_id, in self.env.db_query("""
+                SELECT id FROM gitlab_event_queue
+                WHERE id IN (SELECT MIN(id) FROM gitlab_event_queue
+                             GROUP BY merge_request)
+                    AND worker IS NULL AND next_attempt<=%s
+                ORDER BY id
+                LIMIT %s""", (now, limit)):
+            with self.env.db_transaction as db:
+                cursor = db.cursor()
+                cursor.execute("""
+                    UPDATE gitlab_event_queue SET worker=%s, started=%s
+                    WHERE id=%s AND worker IS NULL
+                    """, (me, now, event_id))
+                if cursor.rowcount == 1:
+                    claimed.append(event_id)
+
+        return claimed
+
+    def _abandon_events(self, pending, now):
+        """
+        Release the claimed events of a terminated worker pool, given as
+        ``(result, deadline, event_id)``.  Events past their deadline count
+        as failed attempts; the others are simply released.
+        """
 
-        req.send_no_content()
+        me = worker_id()
+        for _, deadline, event_id in pending:
+            if deadline >= now:
+                with self.env.db_transaction as db:
+                    db("""
+                        UPDATE gitlab_event_queue SET worker=NULL, started=NULL
+                        WHERE id=%s AND worker=%s
+                        """, (event_id, me))
+                continue
+
+            for attempts, in self.env.db_query("""
+                    SELECT attempts FROM gitlab_event_queue WHERE id=%s
+                    """, (event_id,)):
+                attempts = (attempts or 0) + 1
+                with self.env.db_transaction as db:
+                    if attempts >= self.max_attempts:
+                        self.log.error(
+                            'Gitlab webhook did not finish processing queued '
+                            'event {} within {} seconds after {} attempts; '
+                            'giving up'.format(event_id, self.job_timeout,
+                                               attempts))
+                        db("DELETE FROM gitlab_event_queue WHERE id=%s",
+                           (event_id,))
+                    else:
+                        delay = self.retry_delay * 2 ** (attempts - 1)
+                        self.log.warn(
+                            'Gitlab webhook did not finish processing queued '
+                            'event {} within {} seconds; retrying in {} '
+                            'seconds'.format(event_id, self.job_timeout,
+                                             delay))
+                        db("""
+                            UPDATE gitlab_event_queue
+                            SET attempts=%s, next_attempt=%s, worker=NULL,
+                                started=NULL
+                            WHERE id=%s
+                            """, (attempts, int(now) + delay, event_id))
+
+    def _release_stale_events(self):
+        with self.env.db_transaction as db:
+            for table in ('gitlab_event_queue', 'gitlab_outbox'):
+                db("""
+                    UPDATE %s SET worker=NULL, started=NULL
+                    WHERE worker IS NOT NULL AND started<%%s
+                    """ % table, (int(time.time()) - self.job_timeout,))
+
+    # Outbox of calls to the GitLab API
+
+    @property
+    def client(self):
+        """
+        The `GitlabClient` shared by all threads of this process.
+        """
+
+        if self._gitlab_client is None:
+            self._gitlab_client = GitlabClient(
+                    self.gitlab_url, self.gitlab_api_token,
+                    concurrency=self.api_concurrency)
+        return self._gitlab_client
+
+    def _queue_api_call(self, proj_id, mr_id, action, body=u''):
+        """
+        Queue a call to the GitLab API concerning the given merge request in
+        the outbox, to be sent by `process_event_queue`.
+
+        ``action`` is either ``'note'`` to comment ``body`` on the merge
+        request, or ``'close'`` to close it, then comment ``body``.
+        """
+
+        now = int(time.time())
+        with self.env.db_transaction as db:
+            db("""
+                INSERT INTO gitlab_outbox
+                    (merge_request, action, body, time, attempts,
+                     next_attempt)
+                VALUES (%s, %s, %s, %s, 0, %s)
+                """, ('{}:{}'.format(proj_id, mr_id), action, body, now,
+                      now))
+
+    def _claim_outbox(self, limit):
+        """
+        Claim the queued API calls for up to ``limit`` merge requests whose
+        oldest queued call is ready to be sent, and return the
+        ``proj_id:mr_id`` of those merge requests.
+        """
+
+        if limit <= 0:
+            return []
+
+        claimed = []
+        me = worker_id()
+        now = int(time.time())
+
+        for proj_mr_id, in self.env.db_query("""
+                SELECT merge_request FROM gitlab_outbox
+                WHERE id IN (SELECT MIN(id) FROM gitlab_outbox
+                             GROUP BY merge_request)
+                    AND worker IS NULL AND next_attempt<=%s
+                ORDER BY id
+                LIMIT %s""", (now, limit)):
+            with self.env.db_transaction as db:
+                cursor = db.cursor()
+                cursor.execute("""
+                    UPDATE gitlab_outbox SET worker=%s, started=%s
+                    WHERE merge_request=%s AND worker IS NULL
+                    """, (me, now, proj_mr_id))
+                if cursor.rowcount:
+                    claimed.append(proj_mr_id)
+
+        return claimed
+
+    def _send_outbox(self, proj_mr_id):
+        """
+        Send the claimed API calls for a merge request in order, combining
+        successive comments into one.
+
+        Calls that fail with a retryable error are rescheduled (with the
+        calls queued after them) with exponential backoff, or after the
+        delay requested by GitLab if longer; calls that fail otherwise are
+        dropped.
+        """
+
+        me = worker_id()
+        proj_id, mr_id = (int(x) for x in proj_mr_id.split(':'))
+
+        batches = []
+        for call_id, action, body, attempts in self.env.db_query("""
+                SELECT id, action, body, attempts FROM gitlab_outbox
+                WHERE merge_request=%s AND worker=%s
+                ORDER BY id""", (proj_mr_id, me)):
+            if batches and action == 'note' and batches[-1][1] == 'note':
+                batches[-1][0].append(call_id)
+                batches[-1][2].append(body)
+            else:
+                batches.append(([call_id], action, [body], attempts or 0))
+
+        try:
+            for call_ids, action, bodies, attempts in batches:
+                try:
+                    if action == 'close':
+                        self.client.close_merge_request(proj_id, mr_id)
+                        self.log.info('Successfully closed merge request '
+                                      '{}'.format(mr_id))
+                        # Only the comment remains to be sent if that fails
+                        with self.env.db_transaction as db:
+                            db("""
+                                UPDATE gitlab_outbox SET action='note'
+                                WHERE id=%s""", (call_ids[0],))
+
+                    body = u'\n\n'.join(b for b in bodies if b)
+                    if body:
+                        self.client.post_note(proj_id, mr_id, body)
+                except GitlabApiError as exc:
+                    attempts += 1
+                    if exc.retryable and attempts < self.max_attempts:
+                        delay = max(self.retry_delay * 2 ** (attempts - 1),
+                                    exc.retry_after or 0)
+                        self.log.warn(
+                            'GitLab API call for merge request {} failed; '
+                            'retrying in {} seconds: {}'.format(
+                                proj_mr_id, delay, exc))
+                        with self.env.db_transaction as db:
+                            db("""
+                                UPDATE gitlab_outbox
+                                SET attempts=%s, next_attempt=%s
+                                WHERE merge_request=%s AND worker=%s
+                                """, (attempts, int(time.time()) + delay,
+                                      proj_mr_id, me))
+                        return
+
+                    self.log.error(
+                        'GitLab API call for merge request {} failed; '
+                        'giving up: {}'.format(proj_mr_id, exc))
+
+                with self.env.db_transaction as db:
+                    db("DELETE FROM gitlab_outbox WHERE id IN (%s)" %
+                       ','.join(['%s'] * len(call_ids)), call_ids)
+        except Exception as exc:
+            self.log.error(
+                'Error sending GitLab API calls for merge request {}: '
+                '{}'.format(proj_mr_id, exception_to_unicode(exc, True)))
+        finally:
+            with self.env.db_transaction as db:
+                db("""
+                    UPDATE gitlab_outbox SET worker=NULL, started=NULL
+                    WHERE merge_request=%s AND worker=%s
+                    """, (proj_mr_id, me))
+
+    # IAdminCommandProvider methods
+
+    def get_admin_commands(self):
+        yield ('gitlab work', '[--once]',
+               'Process queued GitLab webhook events using a pool of worker '
+               'processes, and send queued GitLab API calls; with --once, '
+               'exit when no more events or calls are ready to be processed',
+               None, self._do_work)
+        yield ('gitlab fetch-status', '',
+               'Show the number of merge request branch fetches running and '
+               'waiting for a free slot',
+               None, self._do_fetch_status)
+
+    def _do_fetch_status(self):
+        status = self.fetch_scheduler.status()
+        printout('Fetches running: {running}\nFetches waiting: {waiting}\n'
+                 'Longest wait: {max_wait:.1f} seconds'.format(**status))
+
+    def _do_work(self, *args):
+        printout('Processing the GitLab webhook event queue with %d workers' %
+                 self.workers)
+        self.process_event_queue(once='--once' in args)
 
     # ITicketChangeListener methods
 
@@ -138,16 +686,33 @@ class GitlabWebhook(GitBase):
         if 'status' in old_values and ticket['status'] == 'closed':
             # Look up the ticket's MR, if any
             for row in self.env.db_query("""
-                    SELECT value FROM ticket_custom
-                    WHERE ticket=%s AND name=%s""",
-                    (ticket.id, self._field_name)):
+                    SELECT merge_request FROM gitlab_mr_ticket
+                    WHERE ticket=%s""", (ticket.id,)):
                 # There should really be only one, but if for some bizarre
                 # reason there is more than one, let's deal with them anyways
                 proj_id, mr_id = (int(x) for x in row[0].split(':'))
                 self._close_mr(ticket.id, proj_id, mr_id, ticket['resolution'])
 
     def ticket_deleted(self, ticket):
-        pass
+        with self.env.db_transaction as db:
+            db("DELETE FROM gitlab_mr_ticket WHERE ticket=%s", (ticket.id,))
+
+    def _upgrade_schema(self, db, prev_version):
+        if prev_version is not False and prev_version < 2:
+            self._create_tables(db, ['gitlab_mr_ticket'])
+
+        if prev_version is False or prev_version < 2:
+            # Backfill the merge request to ticket mapping from the hidden
+            # custom field, which was previously the only place it was kept
+            db("""
+                INSERT INTO gitlab_mr_ticket (merge_request, ticket)
+                SELECT value, MIN(ticket) FROM ticket_custom
+                WHERE name=%s AND value IS NOT NULL AND value != ''
+                GROUP BY value
+                """, (self._field_name,))
+
+        if prev_version is not False and prev_version < 3:
+            self._create_tables(db, ['gitlab_outbox'])
 
     def _verify_token(self, token):
         if token is None:
@@ -179,9 +744,9 @@ class GitlabWebhook(GitBase):
         upstream_branch = self._upstream_branch(attrs['iid'], source_branch)
 
         # First check if the branch already exists and is up-to-date
-        branch = self._git.lookup_branch(upstream_branch)
+        branch = self.lookup_branch(upstream_branch)
         if branch is not None:
-            if branch.target.hex == attrs['last_commit']['id']:
+            if branch.hex == attrs['last_commit']['id']:
                 self.log.debug(
                     'Upstream branch for MR{} already up to date.'.format(
                         attrs['iid']))
@@ -196,25 +761,84 @@ class GitlabWebhook(GitBase):
         # creating a remote
         self.log.debug('GitLab hook updating branch from {} with refspec '
                        '{}'.format(source_url, refspec))
-        git_args = ('--git-dir={}'.format(self.git_dir), 'fetch',
-                    source_url, refspec)
-        code, output = run_git(*git_args)
+        args = self._fetch_args(branch) + [source_url, refspec]
+        scheduler = self.fetch_scheduler
+        with scheduler.slot(source_url, upstream_branch) as waited:
+            if waited >= 1:
+                self.log.info('GitLab hook waited {:.1f} seconds to fetch '
+                              'branch {}; fetch queue: {}'.format(
+                                  waited, upstream_branch,
+                                  scheduler.status()))
+            start = time.time()
+            code, output = run_git(*args, git_dir=self.git_dir,
+                                   timeout=self.git_timeout)
+            elapsed = time.time() - start
         if code != 0:
             self.log.error('GitLab hook failed to fetch downstream '
                            'branch {} from {}: {}'.format(
                                source_branch, source_url, output))
             return False
 
-        self.log.info('GitLab hook updated branch {} from {}'.format(
-            upstream_branch, source_url))
+        # git only reports the size of larger fetches
+        received = _fetch_received_re.findall(output)
+        if received:
+            received = ' {} objects ({})'.format(*received[-1])
+        else:
+            received = ''
+        self.log.info('GitLab hook updated branch {} from {}; fetched{} in '
+                      '{:.1f} seconds ({} fetch)'.format(
+                          upstream_branch, source_url, received, elapsed,
+                          self.fetch_mode))
         return True
 
+    @property
+    def fetch_scheduler(self):
+        """
+        The `FetchScheduler` limiting concurrent fetches of merge request
+        branches.
+        """
+
+        if self._fetch_scheduler is None:
+            self._fetch_scheduler = FetchScheduler(
+                    self.fetch_lock_dir or
+                        os.path.join(self.env.path, 'fetch-locks'),
+                    max_fetches=self.max_fetches,
+                    max_per_host=self.max_fetches_per_host,
+                    timeout=self.git_timeout)
+        return self._fetch_scheduler
+
+    def _fetch_args(self, branch=None):
+        """
+        Return the arguments to ``git`` (up to and including ``fetch`` and
+        its options) for fetching a merge request branch whose current tip
+        in our repository is ``branch``.
+        """
+
+        args = ['fetch', '--no-tags', '--progress']
+        if self.fetch_mode != 'negotiated':
+            return args
+
+        # Only our commits in the history of the master branch and of the
+        # merge request branch are likely to be shared with the fork, so
+        # restrict the negotiation to those rather than advertising every
+        # ref in the repository
+        args = ['-c', 'protocol.version=2'] + args
+        tips = [self.master_branch]
+        if branch is not None:
+            tips.append(branch.hex)
+
+        for tip in tips:
+            args.append('--negotiation-tip=' + tip)
+
+        return args
+
     def _create_or_update_ticket(self, hook_data, synced_branch=True):
         """
         Create a ticket from a new merge request.
 
-        We use a hidden custom ticket field to store the merge request
-        associated with a ticket, for now.
+        The merge request associated with a ticket is looked up in the
+        gitlab_mr_ticket table; it is also stored in a hidden custom ticket
+        field, which was used for this before that table existed.
         """
 
         attrs = hook_data['object_attributes']
@@ -232,12 +856,9 @@ class GitlabWebhook(GitBase):
         proj_mr_id = '{}:{}'.format(proj_id, mr_id)
 
         for row in self.env.db_query("""
-                SELECT ticket FROM ticket_custom
-                WHERE name=%s AND value=%s""", (self._field_name, proj_mr_id)):
+                SELECT ticket FROM gitlab_mr_ticket
+                WHERE merge_request=%s""", (proj_mr_id,)):
             tkt_id = row[0]
-            # There should only be one; if there are more we might want to
-            # raise a warning...
-            break
 
         ticket = Ticket(self.env, tkt_id=tkt_id)
         if ticket.id is None:
@@ -271,6 +892,10 @@ class GitlabWebhook(GitBase):
                     'webhook: {}'.format(exception_to_unicode(exc, True)))
                 raise
             else:
+                with self.env.db_transaction as db:
+                    db("""
+                        INSERT INTO gitlab_mr_ticket (merge_request, ticket)
+                        VALUES (%s, %s)""", (proj_mr_id, ticket.id))
                 self._post_ticket_to_mr(ticket.id, proj_id, mr_id)
                 self._notify_ticket_event(ticket, 'created')
         else:
@@ -315,38 +940,12 @@ class GitlabWebhook(GitBase):
         if prev_commit == new_commit:
             return
 
-        walker = self._git.walk(self._git[new_commit].oid,
-                        pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_TIME)
         ignore = set([self.master_branch, 'master'])
-
         if prev_commit:
             ignore.add(prev_commit)
 
-        for br in ignore:
-            c = self._git.lookup_branch(br)
-            if c is None:
-                c = self._git.get(br)
-            else:
-                c = c.get_object()
-            if c is not None:
-                walker.hide(c.oid)
-
-        table = []
-
-        for commit in walker:
-            if len(table) > self.max_commits:
-                break
-
-            short_sha1 = commit.hex[:7]
-            title = commit.message.splitlines()
-            if title:
-                title = title[0]
-            else:
-                title = u''
-
-            table.append(
-                u'||[{} {}]||{{{{{{{}}}}}}}||'.format(
-                    self.commit_url(commit.hex), short_sha1, title))
+        table = self.log_table(new_commit, limit=self.max_commits + 1,
+                               ignore=ignore)
 
         comment = (u'New commits added to merge request.  I updated the '
                    'commit SHA-1.')
@@ -367,9 +966,7 @@ class GitlabWebhook(GitBase):
         if not a or a == '0' * 40:
             return True
 
-        a = self._git[a].oid
-        b = self._git[b].oid
-        return self._git.merge_base(a, b) == a
+        return self.is_ancestor(a, b)
 
     def _format_summary(self, hook_data):
         attrs = hook_data['object_attributes']
@@ -423,17 +1020,7 @@ class GitlabWebhook(GitBase):
                 "update the downstream merge request")
             return
 
-        headers = {'Private-Token': self.gitlab_api_token}
-        url = '{}/api/v4/projects/{}/merge_requests/{}/notes'.format(
-                self.gitlab_url.rstrip('/'), proj_id, mr_id)
-
-        try:
-            requests.post(url, data={'body': text}, headers=headers,
-                          timeout=10)
-        except Exception as exc:
-            self.log.error(
-                    'Error comment to GitLab: {}'.format(
-                        exception_to_unicode(exc, True)))
+        self._queue_api_call(proj_id, mr_id, 'note', text)
 
     def _close_mr(self, ticket_id, proj_id, mr_id, resolution):
         if not self.gitlab_api_token:
@@ -442,31 +1029,16 @@ class GitlabWebhook(GitBase):
                 "update the downstream merge request")
             return
 
-        self.log.debug('Trying to close merge request {} since ticket {} '
+        self.log.debug('Queuing closing of merge request {} since ticket {} '
                        'was closed.'.format(mr_id, ticket_id))
 
-        headers = {'Private-Token': self.gitlab_api_token}
-        url = '{}/api/v4/projects/{}/merge_requests/{}'.format(
-                self.gitlab_url.rstrip('/'), proj_id, mr_id)
-        try:
-            requests.put(url, data={'state_event': 'close'},
-                         headers=headers,
-                         timeout=10)
-        except Exception as exc:
-            self.log.error(
-                    'Error updating merge request: {}'.format(
-                        exception_to_unicode(exc, True)))
-            return
-
         text = ("Downstream ticket [Trac#{}]({}) was closed as {}, so I "
                 "closed this merge request.  If you feel this was in error "
                 "feel free to reopen.".format(
                     ticket_id, self.env.abs_href.ticket(ticket_id),
                     resolution))
 
-        self._post_comment_to_mr(proj_id, mr_id, text)
-
-        self.log.info('Successfully closed merge request {}'.format(mr_id))
+        self._queue_api_call(proj_id, mr_id, 'close', text)
 
     def _notify_ticket_event(self, ticket, event, comment=None):
         """
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal client for the parts of the GitLab REST API used by the GitLab
+webhook.
+"""
+
+import threading
+import time
+
+import requests
+import requests.adapters
+
+
+class GitlabApiError(Exception):
+    """
+    Raised when a GitLab API call fails.
+
+    ``status`` is the HTTP status of the response, or `None` if no response
+    was received.  ``retry_after`` is the number of seconds GitLab asked us
+    to wait before trying again, if any.
+    """
+
+    def __init__(self, message, status=None, retry_after=None):
+        super(GitlabApiError, self).__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self):
+        """
+        Whether the call may succeed if tried again later: connection
+        errors, server errors, and rate limiting are retryable, other client
+        errors are not.
+        """
+
+        return self.status is None or self.status == 429 or self.status >= 500
+
+
+class GitlabClient(object):
+    """
+    GitLab API client that can be shared between threads.
+
+    Requests go through a single `requests.Session`, so connections to the
+    GitLab server are kept alive and reused, and at most ``concurrency``
+    requests are in flight at once.
+
+    GitLab's rate limit headers are respected: when a response says no
+    requests remain (``RateLimit-Remaining: 0``) or the request was rate
+    limited (429, with ``Retry-After``), further requests wait until the
+    limit resets.  If that is more than ``max_wait`` seconds away they fail
+    right away with a retryable `GitlabApiError` instead.
+    """
+
+    max_wait = 5
+
+    def __init__(self, url, token, concurrency=4, timeout=10):
+        self.url = url.rstrip('/') + '/api/v4/'
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers['Private-Token'] = token
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        self._resume_at = 0
+
+    def post_note(self, proj_id, mr_id, body):
+        """Add a comment to a merge request."""
+
+        return self.request(
+                'POST', 'projects/{}/merge_requests/{}/notes'.format(
+                    proj_id, mr_id),
+                data={'body': body})
+
+    def close_merge_request(self, proj_id, mr_id):
+        return self.request(
+                'PUT', 'projects/{}/merge_requests/{}'.format(proj_id, mr_id),
+                data={'state_event': 'close'})
+
+    def request(self, method, path, **kwargs):
+        """
+        Make a request to the API endpoint at ``path`` (relative to
+        ``/api/v4/``), and return the response.
+
+        Raises `GitlabApiError` if no response is received or its status is
+        not a success.
+        """
+
+        kwargs.setdefault('timeout', self.timeout)
+
+        with self._slots:
+            self._wait_for_rate_limit()
+            try:
+                resp = self.session.request(method, self.url + path,
+                                            **kwargs)
+            except requests.RequestException as exc:
+                raise GitlabApiError('{} {} failed: {}'.format(
+                    method, path, exc))
+
+            retry_after = self._update_rate_limit(resp)
+
+        if resp.status_code >= 400:
+            raise GitlabApiError(
+                '{} {} failed with status {}: {}'.format(
+                    method, path, resp.status_code, resp.text[:200]),
+                status=resp.status_code, retry_after=retry_after)
+
+        return resp
+
+    def _wait_for_rate_limit(self):
+        with self._lock:
+            wait = self._resume_at - time.time()
+
+        if wait > self.max_wait:
+            raise GitlabApiError('GitLab API rate limit exceeded',
+                                 status=429, retry_after=int(wait) + 1)
+        elif wait > 0:
+            time.sleep(wait)
+
+    def _update_rate_limit(self, resp):
+        """
+        Record when requests may be made again if the response says the rate
+        limit was reached, and return the number of seconds until then.
+        """
+
+        now = time.time()
+        resume_at = None
+
+        retry_after = resp.headers.get('Retry-After')
+        if resp.status_code == 429 and retry_after:
+            try:
+                resume_at = now + int(retry_after)
+            except ValueError:
+                pass
+
+        if (resume_at is None and
+                (resp.status_code == 429 or
+                 resp.headers.get('RateLimit-Remaining') == '0')):
+            try:
+                resume_at = int(resp.headers['RateLimit-Reset'])
+            except (KeyError, ValueError):
+                if resp.status_code == 429:
+                    resume_at = now + 60
+
+        if resume_at is None:
+            return None
+
+        with self._lock:
+            self._resume_at = max(self._resume_at, resume_at)
+
+        return max(int(resume_at - now), 0)
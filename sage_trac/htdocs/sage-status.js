@@ -0,0 +1,68 @@
+/*
+ * Fills in the build and merge status of a ticket's branch, rendered by
+ * BuildbotHook as an empty #buildbot-status placeholder, from the
+ * /buildbot/status/<ticket> endpoint.
+ *
+ * The endpoint's responses carry an ETag and are marked no-cache, so the
+ * browser revalidates them with If-None-Match; the endpoint asks to be
+ * polled again (after "poll" seconds) only while a build or merge is
+ * pending.
+ */
+jQuery(function($) {
+  var box = $('#buildbot-status');
+  if (!box.length) {
+    return;
+  }
+
+  var mergeResults = {
+    merged: 'Merged cleanly',
+    fastforward: 'Fast-forward',
+    uptodate: 'Already merged',
+    failed: 'Merge failed'
+  };
+
+  function link(text, url, cls) {
+    if (!url) {
+      return $('<span/>').text(text);
+    }
+    return $('<a/>').text(text).attr('href', url).addClass(cls || '');
+  }
+
+  function render(status) {
+    var build = status.build;
+    var merge = status.merge;
+
+    box.find('.buildbot-result').parent().toggle(!!build);
+    if (build) {
+      box.find('.buildbot-result').empty().append(
+          link(build.result, build.url, build['class']));
+    }
+
+    box.find('.merge-result').parent().toggle(!!merge);
+    if (merge) {
+      box.find('.merge-result').empty().append(
+          merge.result ?
+            link(mergeResults[merge.result], merge.url,
+                 merge.result == 'failed' ? 'needs_work' : null) :
+            $('<span/>').text('Pending'));
+    }
+
+    box.toggle(!!(build || merge));
+  }
+
+  function update() {
+    $.ajax({
+      url: box.data('url'),
+      dataType: 'json',
+      // Leave caching to the browser, which revalidates using the ETag
+      cache: true
+    }).done(function(status) {
+      render(status);
+      if (status.poll) {
+        setTimeout(update, status.poll * 1000);
+      }
+    });
+  }
+
+  update();
+});
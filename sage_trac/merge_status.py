@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Show the merge status of ticket branches in ticket queries and reports.
+"""
+
+from trac.core import implements
+from trac.web.api import IRequestFilter
+
+from .common import GitBase, _chunks
+from . import git_merger
+
+
+MERGE_STATUS_LABELS = {
+    git_merger.GIT_UPTODATE: 'merged',
+    git_merger.GIT_FASTFORWARD: 'fast-forward',
+    git_merger.GIT_FAILED_MERGE: 'failed'
+}
+
+
+class MergeStatusColumn(GitBase):
+    """
+    Adds a "Merge" column to ticket queries and reports that display the
+    ``branch`` column, showing whether each ticket's branch merges cleanly
+    into the master branch.
+
+    The status is read from the merge preview cache with one query per page
+    of results, so this never computes any merges; tickets whose merge
+    preview has not been generated yet (or that have a ``base_branch``) are
+    left blank.  This relies on the ``commit`` field of tickets being kept
+    up to date by the `TicketLog` component.
+    """
+
+    implements(IRequestFilter)
+
+    _column = 'merge'
+    _label = 'Merge'
+
+    # IRequestFilter methods
+    def pre_process_request(self, req, handler):
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        if data is None:
+            return template, data, content_type
+
+        if template == 'query.html':
+            self._add_query_column(data)
+        elif template == 'report_view.html':
+            self._add_report_column(data)
+
+        return template, data, content_type
+
+    def _add_query_column(self, data):
+        headers = data.get('headers') or []
+        for idx, header in enumerate(headers):
+            if header['name'] == 'branch':
+                break
+        else:
+            return
+
+        headers.insert(idx + 1, {'name': self._column, 'label': self._label,
+                                 'field': None, 'href': None, 'asc': None,
+                                 'wikify': False})
+
+        tickets = data.get('tickets') or []
+        statuses = self.get_merge_statuses(t['id'] for t in tickets)
+        for ticket in tickets:
+            ticket[self._column] = statuses.get(ticket['id'], '')
+
+    def _add_report_column(self, data):
+        for group_idx, header_group in enumerate(
+                data.get('header_groups') or []):
+            for idx, header in enumerate(header_group):
+                if header['col'].strip('_') == 'branch':
+                    break
+            else:
+                continue
+            break
+        else:
+            return
+
+        header = {'col': self._column, 'title': self._label,
+                  'hidden': False, 'asc': None}
+        header_group.insert(idx + 1, header)
+
+        rows = [row for _, row_group in data.get('row_groups') or []
+                for row in row_group]
+        statuses = self.get_merge_statuses(row['id'] for row in rows
+                                           if row.get('id'))
+        for row in rows:
+            row['cell_groups'][group_idx].insert(idx + 1, {
+                'value': statuses.get(row.get('id'), ''),
+                'header': header,
+                'index': idx + 1
+            })
+
+    def get_merge_statuses(self, ticket_ids):
+        """
+        Return a dict mapping ticket IDs to a short description of the
+        cached merge status of the ticket's branch into the master branch.
+
+        Tickets with no cached merge are omitted.
+        """
+
+        master = self.master
+        if master is None:
+            return {}
+
+        ticket_ids = set(int(ticket_id) for ticket_id in ticket_ids)
+
+        statuses = {}
+        with self.env.db_query as db:
+            for chunk in _chunks(ticket_ids):
+                for ticket_id, tmp in db("""
+                        SELECT c.ticket, m.tmp FROM ticket_custom c
+                        INNER JOIN merge_store m
+                            ON m.target=c.value AND m.base=%%s
+                        LEFT OUTER JOIN ticket_custom bb
+                            ON bb.ticket=c.ticket AND bb.name='base_branch'
+                        WHERE c.name='commit' AND c.ticket IN (%s) AND
+                            (bb.value IS NULL OR bb.value='')
+                        """ % ','.join(['%s'] * len(chunk)),
+                        [master.hex] + chunk):
+                    statuses[ticket_id] = MERGE_STATUS_LABELS.get(tmp,
+                                                                  'clean')
+
+        return statuses
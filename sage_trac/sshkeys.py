@@ -2,26 +2,27 @@ import os
 import shutil
 import socket
 import sys
+import time
 
 from trac.core import Component, implements, TracError
-from trac.config import Option, PathOption
+from trac.config import BoolOption, IntOption, Option, PathOption
 from trac.db.schema import Table, Column, Index
 from trac.web.chrome import ITemplateProvider, add_notice, add_warning
 from trac.util.translation import gettext
 from trac.prefs import IPreferencePanelProvider
 from trac.admin.api import IAdminCommandProvider
-from trac.util.text import printout
+from trac.util.text import exception_to_unicode, printout
 from trac.util.html import escape
 
 from tracrpc.api import IXMLRPCHandler
 
 from genshi import Markup
 
-from threading import Lock, current_thread
+from threading import Event, Lock, Thread, current_thread
 from fasteners import InterProcessLock as IPLock, locked as locked_
 from sshpubkeys import SSHKey, InvalidKeyException
 
-from .common import GenericTableProvider, run_git
+from .common import GenericTableProvider, _chunks, run_git
 
 
 def _my_id():
@@ -157,6 +158,32 @@ class SshKeysPlugin(GenericTableProvider):
             doc='author e-mail to use when committing updates to the '
                 'gitolite-admin repository')
 
+    gitolite_timeout = IntOption(
+            'sage_trac', 'gitolite_timeout', 60,
+            doc='number of seconds after which git commands run on the '
+                'gitolite-admin repository are aborted (default: 60)')
+
+    gitolite_flush_in_background = BoolOption(
+            'sage_trac', 'gitolite_flush_in_background', 'true',
+            doc='if enabled (the default), pending SSH key changes are '
+                'exported to gitolite by a background thread of the Trac '
+                'process shortly after they are made; otherwise they must '
+                'be flushed with `trac-admin <env> sshkeys flush` (e.g. '
+                'from cron)')
+
+    gitolite_batch_delay = IntOption(
+            'sage_trac', 'gitolite_batch_delay', 2,
+            doc='number of seconds the background thread waits after an '
+                'SSH key change before exporting pending changes, so that '
+                'changes made in the meantime go into the same commit and '
+                'push (default: 2)')
+
+    gitolite_retry_delay = IntOption(
+            'sage_trac', 'gitolite_retry_delay', 60,
+            doc='number of seconds after which the background thread tries '
+                'again to export pending SSH key changes if exporting them '
+                'failed (default: 60)')
+
     _schema = [
         Table('sage_trac_ssh_keys', key=('username', 'key_order'))[
             Column('username'),
@@ -164,10 +191,17 @@ class SshKeysPlugin(GenericTableProvider):
             Column('title'),  # currently unused, but included in anticipation
             Column('key_order', type='int'),
             Index(('username',))
+        ],
+        # Users whose keys have changed since they were last exported to
+        # gitolite
+        Table('sage_trac_ssh_key_changes', key='id')[
+            Column('id', auto_increment=True),
+            Column('username'),
+            Column('time', type='int')
         ]
     ]
 
-    _schema_version = 1
+    _schema_version = 2
 
     def __init__(self):
         super(SshKeysPlugin, self).__init__()
@@ -185,6 +219,10 @@ class SshKeysPlugin(GenericTableProvider):
 
         self._locks = [IPLock(lockfile), Lock()]
 
+        self._flush_event = Event()
+        self._flush_thread = None
+        self._flush_thread_lock = Lock()
+
         # This is something of a hack for now, but necessary.  The
         # gitolite-admin clone should not be created when running trac-admin,
         # as trac-admin is typically run as root (or some other user not
@@ -192,6 +230,16 @@ class SshKeysPlugin(GenericTableProvider):
         # public key, and may have the wrong permissions
         if sys.argv[0] != 'trac-admin':
             self._init_gitolite_admin()
+            # Export any changes left pending by processes that exited
+            # before flushing them (unless the environment has yet to be
+            # upgraded to have the table for them)
+            try:
+                pending = self._has_pending_changes()
+            except self.env.db_exc.DatabaseError:
+                pending = False
+
+            if pending:
+                self._schedule_flush()
 
     @locked
     def _init_gitolite_admin(self):
@@ -303,7 +351,8 @@ class SshKeysPlugin(GenericTableProvider):
                 # It's possible validatekeys could have removed all keys from
                 # new_ssh_keys
                 self.setkeys(req, new_ssh_keys)
-                add_notice(req, 'Your ssh key has been saved.')
+                add_notice(req, 'Your ssh key has been saved, and will be '
+                                'usable within a few minutes.')
             req.redirect(req.href.prefs(panel or None))
 
         ssh_keys = '\n'.join(key[0] for key in self._getkeys(req.authname))
@@ -325,6 +374,10 @@ class SshKeysPlugin(GenericTableProvider):
         yield ('sshkeys dumpkey', '<user>',
                "export the <user>'s SSH key to stdout",
                None, self._do_dump_key)
+        yield ('sshkeys flush', '',
+               'Export all pending SSH key changes to gitolite in a single '
+               'commit and push',
+               None, self._do_flush)
 
     # AdminCommandProvider boilerplate
 
@@ -335,55 +388,152 @@ class SshKeysPlugin(GenericTableProvider):
     def _do_dump_key(self, user):
         printout([key[0] for key in self._getkeys(user)])
 
+    def _do_flush(self):
+        count = self.flush_key_changes()
+        printout('Exported the SSH keys of %d users' % count)
+
     def _git(self, *args, **kwargs):
         chdir = kwargs.get('chdir', self.gitolite_admin)
         self.log.debug('[%s] Calling `git %s` in %s' %
                        (_my_id(), ' '.join(args), chdir or os.getcwd()))
 
-        return run_git(*args, chdir=chdir)
+        return run_git(*args, cwd=chdir, timeout=self.gitolite_timeout)
 
     # Gitolite exporting
+    def flush_key_changes(self):
+        """
+        Export the keys of all users with pending key changes to the
+        gitolite-admin repository, in a single commit and push, and return
+        the number of users whose keys were exported.
+
+        Raises `TracError` if updating the repository fails, in which case
+        the changes are left pending.
+        """
+
+        if not self._has_pending_changes():
+            return 0
+
+        return self._export_to_gitolite()
+
+    def _has_pending_changes(self):
+        return self.env.db_query("""
+            SELECT COUNT(*) FROM sage_trac_ssh_key_changes
+            """)[0][0] > 0
+
+    def _schedule_flush(self):
+        """
+        Have the background thread of this process export pending key
+        changes shortly, starting the thread if needed.
+        """
+
+        if not self.gitolite_flush_in_background:
+            return
+
+        with self._flush_thread_lock:
+            # Threads do not survive forking, so this also restarts the
+            # thread in forked server processes
+            if self._flush_thread is None or not self._flush_thread.is_alive():
+                self._flush_thread = Thread(target=self._flush_loop,
+                                            name='sshkeys-flush')
+                self._flush_thread.daemon = True
+                self._flush_thread.start()
+
+        self._flush_event.set()
+
+    def _flush_loop(self):
+        while True:
+            self._flush_event.wait()
+            # Let changes made in quick succession pile up, so they are
+            # exported together
+            time.sleep(self.gitolite_batch_delay)
+            self._flush_event.clear()
+
+            try:
+                self.flush_key_changes()
+            except Exception as exc:
+                self.log.error(
+                    'Exporting SSH keys to gitolite failed; trying again in '
+                    '%d seconds: %s', self.gitolite_retry_delay,
+                    exception_to_unicode(exc, True))
+                time.sleep(self.gitolite_retry_delay)
+                self._flush_event.set()
+
     @locked
-    def _export_to_gitolite(self, user, keys):
+    def _export_to_gitolite(self):
         def _mkdir(path):
             if not os.path.isdir(path):
                 _mkdir(os.path.dirname(path))
                 os.mkdir(path)
 
-        def get_keyname(idx):
-            dirno = '{0:>02}'.format(hex(idx)[2:])
-            keydir = os.path.join(self.gitolite_admin, 'keydir', dirno)
-            return os.path.join(keydir, user + '.pub')
+        def run_cmds(cmds):
+            for cmd in cmds:
+                ret, out = self._git(*cmd)
+                if ret != 0:
+                    # Error occurred; attempt rollback
+                    self._git('reset', '--hard', 'origin/master')
+                    raise TracError('A git error occurred while exporting '
+                                    'SSH keys to gitolite: {0}; the '
+                                    'attempted command was {1}'.format(
+                                        out, cmd))
+
+        # Changes made after this are exported by the next flush
+        changes = self.env.db_query("""
+            SELECT id, username FROM sage_trac_ssh_key_changes
+            """)
+        if not changes:
+            return 0
+
+        users = sorted(set(user for _, user in changes))
+
+        run_cmds([('pull', '-s', 'recursive', '-Xours', 'origin', 'master')])
+
+        # The subdirectories of keydir holding each user's Nth key, which
+        # are scanned for keys to delete when users now have fewer keys
+        keydir = os.path.join(self.gitolite_admin, 'keydir')
+        key_subdirs = []
+        if os.path.isdir(keydir):
+            for name in os.listdir(keydir):
+                try:
+                    key_subdirs.append((int(name, 16), name))
+                except ValueError:
+                    continue
 
         added_keys = []
         deleted_keys = []
 
-        for idx, key in enumerate(keys):
-            keyname = get_keyname(idx)
-            _mkdir(os.path.dirname(keyname))
-            with open(keyname, 'w') as f:
-                f.write(key)
-            added_keys.append(keyname)
-
-        for idx in range(len(keys), len(list(self._getkeys(user)))):
-            keyname = get_keyname(idx)
-            try:
-                os.unlink(keyname)
-            except OSError:
-                pass
-            else:
-                deleted_keys.append(keyname)
-
-        cmds = [('pull', '-s', 'recursive', '-Xours', 'origin', 'master')]
-
-        if added_keys:
-            cmds.append(('add',) + tuple(added_keys))
+        for user in users:
+            keys = [key for key, _ in self._getkeys(user)]
+            for idx, key in enumerate(keys):
+                dirno = '{0:>02}'.format(hex(idx)[2:])
+                keyname = os.path.join(keydir, dirno, user + '.pub')
+                _mkdir(os.path.dirname(keyname))
+                with open(keyname, 'w') as f:
+                    f.write(key)
+                added_keys.append(keyname)
+
+            for idx, name in key_subdirs:
+                if idx < len(keys):
+                    continue
+
+                keyname = os.path.join(keydir, name, user + '.pub')
+                try:
+                    os.unlink(keyname)
+                except OSError:
+                    pass
+                else:
+                    deleted_keys.append(keyname)
 
-        if deleted_keys:
-            cmds.append(('rm',) + tuple(deleted_keys))
+        cmds = []
+        for chunk in _chunks(added_keys):
+            cmds.append(('add',) + tuple(chunk))
+        for chunk in _chunks(deleted_keys):
+            cmds.append(('rm', '--cached', '--ignore-unmatch') +
+                        tuple(chunk))
+        run_cmds(cmds)
 
         ret, out = self._git('status', '--porcelain')
         if ret != 0:
+            self._git('reset', '--hard', 'origin/master')
             raise TracError("An unexpected git error occurred: "
                             "{0}".format(out))
 
@@ -391,19 +541,22 @@ class SshKeysPlugin(GenericTableProvider):
             # If git status did *not* produce output then nothing
             # changed in the repository (i.e. no keys changed) so there
             # is nothing to commit or push
-            cmds.extend([
-                ('commit', '-m', 'trac: updating user keys'),
+            run_cmds([
+                ('commit', '-m', 'trac: updating keys of {0} user{1}'.format(
+                    len(users), '' if len(users) == 1 else 's')),
                 ('push', 'origin', 'master')
             ])
 
-        for cmd in cmds:
-            ret, out = self._git(*cmd)
-            if ret != 0:
-                # Error occurred; attempt rollback
-                self._git('reset', '--hard', 'origin/master')
-                raise TracError('A git error occurred while saving your '
-                                'updated SSH keys: {0}; the attempted '
-                                'command was {1}'.format(out, cmd))
+        with self.env.db_transaction as db:
+            ids = [change_id for change_id, _ in changes]
+            for chunk in _chunks(ids):
+                db("""
+                    DELETE FROM sage_trac_ssh_key_changes WHERE id IN (%s)
+                    """ % ','.join(['%s'] * len(chunk)), chunk)
+
+        self.log.info('Exported the SSH keys of %d users to gitolite',
+                      len(users))
+        return len(users)
 
     # general functionality
     def _listusers(self):
@@ -420,8 +573,6 @@ class SshKeysPlugin(GenericTableProvider):
             yield key, title
 
     def _setkeys(self, user, keys):
-        self._export_to_gitolite(user, keys)
-
         with self.env.db_transaction as db:
             # Since _setkeys is passed a full list of keys right now the
             # simplest thing to do is delete all existing entries and insert
@@ -431,6 +582,15 @@ class SshKeysPlugin(GenericTableProvider):
                 db('INSERT INTO "sage_trac_ssh_keys" VALUES (%s, %s, %s, %s)',
                    (user, key, '', idx))
 
+            # The keys are exported to gitolite later, together with those
+            # of other users changed in the meantime
+            db("""
+                INSERT INTO sage_trac_ssh_key_changes (username, time)
+                VALUES (%s, %s)
+                """, (user, int(time.time())))
+
+        self._schedule_flush()
+
     # RPC boilerplate
     def listusers(self, req):
         return list(self._listusers())
@@ -510,6 +670,9 @@ class SshKeysPlugin(GenericTableProvider):
 
     # GenericTableProvider methods
     def _upgrade_schema(self, db, prev_version):
+        if prev_version is not False and prev_version < 2:
+            self._create_tables(db, ['sage_trac_ssh_key_changes'])
+
         if prev_version is False:
             # previous versions of this plugin used the generic version key
             # 'sage_trac' for the entire plugin, before adding different
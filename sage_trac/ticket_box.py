@@ -7,17 +7,16 @@ from genshi.core import TEXT
 from genshi.filters import Transformer
 
 from trac.cache import cached
-from trac.core import implements, TracError
-from trac.config import Option, ConfigSection
+from trac.core import implements
+from trac.config import IntOption, Option, ConfigSection
 from trac.web.api import ITemplateStreamFilter
 from trac.web.chrome import add_stylesheet, ITemplateProvider
 
-from .common import _signature_re
+from .common import hexify, LRUCache
 
 from . import git_merger
 
 import pkg_resources
-import pygit2
 
 FILTER_PROPERTIES = Transformer(
     '//div[@id="ticket"]/table[@class="properties"]')
@@ -40,13 +39,6 @@ class TicketBox(git_merger.GitMerger):
     """
     implements(ITemplateStreamFilter, ITemplateProvider)
 
-    release_manager_signature = Option(
-            'sage_trac', 'release_manager_signature',
-            'Release Manager <release@sagemath.org>',
-            doc='signature to use on commits (especially merges) made '
-                'through action of the project release manager (default: '
-                '"Release Manager <release@sagemath.org>)')
-
     patchbot_url = Option(
             'sage_trac', 'patchbot_url', '',
             'base URL of the Sage patchbot server from which to show '
@@ -91,6 +83,14 @@ class TicketBox(git_merger.GitMerger):
             together.
             """)
 
+    render_cache_size = IntOption(
+            'sage_trac', 'ticket_box_cache_size', 1000,
+            doc='number of tickets for which the merge status and commit log '
+                'link of the branch is cached in each process, so that '
+                'repeat views of a ticket need no git history walks or '
+                'database queries until the branch or its base moves '
+                '(default: 1000)')
+
     # Templates on which this filter should be applied
     _templates = set(['ticket_change.html', 'ticket_preview.html',
                       'ticket.html'])
@@ -98,13 +98,9 @@ class TicketBox(git_merger.GitMerger):
     def __init__(self):
         super(TicketBox, self).__init__()
 
-        m = _signature_re.match(self.release_manager_signature)
-        if not m:
-            raise TracError(
-                '[sage_trac]/release_manager_signature in trac.ini must be '
-                'in the "Name <email@example.com>" format')
-
-        self._release_signature = pygit2.Signature(m.group(1), m.group(2))
+        # Maps (branch tip, base tip, ticket status, base branch) to the
+        # cached merge result and log URL for the branch
+        self._render_cache = LRUCache(self.render_cache_size)
 
     @cached
     def status_badges(self):
@@ -271,9 +267,25 @@ class TicketBox(git_merger.GitMerger):
             else:
                 return error("sha1 hash is too ambiguous")
 
-        ret = self.peek_merge(branch_commit, base_branch=base_branch)
-        _, log_url = self.get_merge_url(req, branch_commit, ret,
-                                        base=base_branch_commit)
+        if base_branch_commit is not None:
+            base_commit = base_branch_commit
+        else:
+            base_commit = self.master
+
+        cache_key = (branch_commit.hex, hexify(base_commit), ticket['status'],
+                     base_branch)
+        cached = self._render_cache.get(cache_key)
+        if cached is not None:
+            ret, log_url = cached
+        else:
+            ret = self.peek_merge(branch_commit, base_branch=base_branch)
+            _, log_url = self.get_merge_url(req, branch_commit, ret,
+                                            base=base_branch_commit)
+            ret = hexify(ret)
+            if ret is not None:
+                # Only cache final merge results; the merge may be computed
+                # at any time without either tip moving
+                self._render_cache[cache_key] = (ret, log_url)
 
         # For the merge-url just always pass through the git-merger frontend
         params = []
@@ -316,9 +328,6 @@ class TicketBox(git_merger.GitMerger):
         return filters
 
     # ITemplateProvider methods
-    def get_templates_dirs(self):
-        return []
-
     def get_htdocs_dirs(self):
         return [('sage_trac',
                  pkg_resources.resource_filename('sage_trac', 'htdocs'))]
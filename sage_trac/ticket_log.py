@@ -38,41 +38,6 @@ class TicketLog(GitBase):
         except ValueError:
             return
 
-    def log_table(self, new_commit, limit=float('inf'), ignore=[]):
-        walker = self._git.walk(self._git[new_commit].oid,
-                pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_TIME)
-
-        for b in ignore:
-            c = self._git.lookup_branch(b)
-            if c is None:
-                try:
-                    c = self._git.get(b)
-                except ValueError:
-                    continue
-            else:
-                c = c.get_object()
-
-            if c is not None:
-                walker.hide(c.oid)
-
-        table = []
-
-        for commit in walker:
-            if len(table) >= limit:
-                break
-            short_sha1 = commit.hex[:7]
-            title = commit.message.splitlines()
-            if title:
-                title = title[0]
-            else:
-                title = u''
-            table.append(
-                    u'||[%s %s]||{{{%s}}}||' % (
-                        self.commit_url(commit),
-                        short_sha1,
-                        title))
-        return table
-
     # doesn't actually do anything, according to the api
     def prepare_ticket(self, req, ticket, fields, actions):
         pass
@@ -83,11 +48,11 @@ class TicketLog(GitBase):
         old_commit = self._valid_commit(ticket['commit'])
         if branch:
             ticket['branch'] = branch = branch.strip()
-            commit = self._git.lookup_branch(branch)
+            commit = self.ref_index.lookup('refs/heads/' + branch)
             if commit is None:
                 commit = ticket['commit'] = u''
             else:
-                commit = ticket['commit'] = unicode(commit.get_object().hex)
+                commit = ticket['commit'] = unicode(commit)
         else:
             commit = ticket['commit'] = u''
 
@@ -9,7 +9,7 @@ setup(
         packages=find_packages(),
         zip_safe=True,
         package_data={'sage_trac': ['templates/*.html',
-                                    'htdocs/*.css']},
+                                    'htdocs/*.css', 'htdocs/*.js']},
         install_requires=[
             'pygit2',
             'TracXMLRPC',
@@ -27,6 +27,7 @@ setup(
                 # 'sage_trac.buildbot_hook = sage_trac.buildbot_hook',
                 'sage_trac.gitlab = sage_trac.gitlab',
                 'sage_trac.markdown = sage_trac.markdown',
+                'sage_trac.merge_status = sage_trac.merge_status',
                 'sage_trac.search_branch = sage_trac.search_branch',
                 'sage_trac.sshkeys = sage_trac.sshkeys',
                 'sage_trac.ticket_box = sage_trac.ticket_box',
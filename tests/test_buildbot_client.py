@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the buildbot PB client, against a fake buildbot change source.
+"""
+
+import os
+import time
+
+import pytest
+
+pytest.importorskip('twisted')
+
+from twisted.cred import checkers, portal
+from twisted.internet import defer, threads
+from twisted.spread import pb
+from zope.interface import implementer
+
+from sage_trac.buildbot_client import BuildbotClient, _get_reactor
+
+
+class ChangeSource(pb.Avatar):
+    """
+    The perspective of the fake change source's user.
+
+    Changes are acknowledged once ``hold`` changes have been received (so
+    that a client waiting for each change to be acknowledged before
+    sending the next one would stall), and changes with ``'reject'`` in
+    their comments are rejected.
+    """
+
+    def __init__(self, master):
+        self.master = master
+
+    def perspective_addChange(self, change):
+        master = self.master
+        master.changes.append(change)
+        if 'reject' in change.get('comments', ''):
+            raise ValueError('rejected %s' % change['revision'])
+
+        deferred = defer.Deferred()
+        master.held.append(deferred)
+        if len(master.held) >= master.hold:
+            held, master.held = master.held, []
+            for d in held:
+                d.callback(None)
+        return deferred
+
+
+@implementer(portal.IRealm)
+class FakeMaster(object):
+    def __init__(self, hold=1):
+        self.hold = hold
+        self.held = []
+        self.changes = []
+        self.connections = 0
+        self.brokers = []
+        self.checker = \
+            checkers.InMemoryUsernamePasswordDatabaseDontUse(trac='secret')
+        self.factory = pb.PBServerFactory(portal.Portal(self, [self.checker]))
+        self.factory.protocol = self._protocol
+        self.port = None
+
+    def _protocol(self, *args, **kwargs):
+        self.connections += 1
+        broker = pb.Broker(*args, **kwargs)
+        self.brokers.append(broker)
+        return broker
+
+    def requestAvatar(self, avatar_id, mind, *interfaces):
+        return pb.IPerspective, ChangeSource(self), lambda: None
+
+    def listen(self, port=0):
+        self.port = _get_reactor().listenTCP(port, self.factory,
+                                      interface='127.0.0.1')
+        return self.port.getHost().port
+
+    def disconnect(self):
+        for broker in self.brokers:
+            broker.transport.loseConnection()
+
+
+def call(func, *args, **kwargs):
+    """Call ``func`` in the reactor thread and return its result."""
+
+    return threads.blockingCallFromThread(_get_reactor(), func, *args,
+                                          **kwargs)
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def master():
+    master = FakeMaster()
+    call(master.listen)
+
+    yield master
+
+    call(master.port.stopListening)
+    call(master.disconnect)
+
+
+def make_client(master, password='secret'):
+    client = BuildbotClient('127.0.0.1', master.port.getHost().port, 'trac',
+                            password)
+    # Keep the reconnection delays short
+    client._factory.maxDelay = 0.5
+    client._factory.initialDelay = 0.1
+    client._connect()
+    return client
+
+
+def change(n, comments=u''):
+    return {'revision': u'%040x' % n, 'comments': comments,
+            'branch': u'u/trac/%d' % n}
+
+
+def test_changes_are_queued_and_pipelined(master):
+    master.hold = 20
+    client = make_client(master)
+
+    # Submitted before the connection is made
+    results = [client.add_change(change(n)) for n in range(20)]
+
+    assert all(result.wait(10) for result in results)
+    assert client.connected
+    assert [c['revision'] for c in master.changes] == \
+        [change(n)['revision'] for n in range(20)]
+
+
+def test_callback(master):
+    client = make_client(master)
+    called = []
+
+    result = client.add_change(change(1), lambda: called.append(True))
+
+    assert result.wait(10)
+    assert called == [True]
+
+
+def test_rejected_change(master):
+    client = make_client(master)
+
+    rejected = client.add_change(change(1, u'reject'))
+    accepted = client.add_change(change(2))
+
+    assert not rejected.wait(10)
+    assert rejected.done
+    assert 'rejected %s' % change(1)['revision'] in rejected.error
+    assert accepted.wait(10)
+
+
+def test_reconnect(master):
+    client = make_client(master)
+    assert client.add_change(change(1)).wait(10)
+
+    call(master.disconnect)
+    wait_for(lambda: master.connections == 2 and client.connected)
+
+    assert client.add_change(change(2)).wait(10)
+    assert len(master.changes) == 2
+
+
+def test_login_failure(master):
+    client = make_client(master, password='wrong')
+    results = [client.add_change(change(n)) for n in range(3)]
+
+    # The queued changes fail instead of waiting forever
+    for result in results:
+        assert not result.wait(10)
+        assert result.done
+        assert 'logging in to buildbot failed' in result.error
+    assert not client.connected
+    assert master.changes == []
+
+    # Logging in is retried on a new connection
+    call(master.checker.addUser, 'trac', 'wrong')
+    wait_for(lambda: client.connected)
+    assert master.connections > 1
+    assert client.add_change(change(4)).wait(10)
+
+
+def test_fork(master):
+    port = master.port.getHost().port
+    client = BuildbotClient.get('127.0.0.1', port, 'trac', 'secret')
+    assert client.add_change(change(1)).wait(10)
+
+    pid = os.fork()
+    if pid == 0:
+        # The parent's client and reactor thread are not usable here
+        status = 1
+        try:
+            child_client = BuildbotClient.get('127.0.0.1', port, 'trac',
+                                              'secret')
+            if (child_client is not client and
+                    child_client.add_change(change(2)).wait(10)):
+                status = 0
+        finally:
+            os._exit(status)
+
+    _, status = os.waitpid(pid, 0)
+    assert status == 0
+    assert [c['revision'] for c in master.changes] == \
+        [change(1)['revision'], change(2)['revision']]
+
+    # The parent's client is still connected
+    assert client.add_change(change(3)).wait(10)
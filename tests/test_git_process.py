@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for running git commands with a timeout.
+"""
+
+import socket
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('trac')
+pytest.importorskip('pygit2')
+
+from sage_trac.common import run_git
+
+
+@pytest.fixture
+def hanging_server():
+    """
+    An HTTP "server" that accepts connections but never answers them.
+    """
+
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    conns = []
+    stop = threading.Event()
+
+    def accept():
+        server.settimeout(0.2)
+        while not stop.is_set():
+            try:
+                conns.append(server.accept()[0])
+            except socket.timeout:
+                continue
+
+    thread = threading.Thread(target=accept)
+    thread.daemon = True
+    thread.start()
+
+    yield 'http://127.0.0.1:%d/repo.git' % server.getsockname()[1]
+
+    stop.set()
+    thread.join()
+    for conn in conns:
+        conn.close()
+    server.close()
+
+
+def test_output():
+    code, out = run_git('--version')
+    assert code == 0
+    assert out.startswith('git version')
+
+
+def test_timeout_kills_remote_helper(hanging_server, tmpdir):
+    start = time.time()
+    code, out = run_git('ls-remote', hanging_server, cwd=str(tmpdir),
+                        timeout=2)
+    assert time.time() - start < 10
+    assert code != 0
+    assert 'timed out after 2 seconds' in out
+
+
+def test_timeout_kills_shell_alias(tmpdir):
+    start = time.time()
+    code, out = run_git('-c', 'alias.hang=!sleep 30', 'hang',
+                        cwd=str(tmpdir), timeout=1)
+    assert time.time() - start < 5
+    assert code != 0
+    assert 'timed out after 1 seconds' in out
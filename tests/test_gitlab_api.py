@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the GitLab API client and the GitLab webhook's outbox of API
+calls, against a stub GitLab server.
+"""
+
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('trac')
+pygit2 = pytest.importorskip('pygit2')
+pytest.importorskip('requests')
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+
+from sage_trac.gitlab_api import GitlabApiError, GitlabClient
+
+
+class StubGitlab(ThreadingMixIn, HTTPServer):
+    """
+    Answers requests with the responses queued in ``responses`` (a status,
+    headers, and JSON body each), or with 201 and an empty object once
+    there are none left, and records each request as ``(method, path, form
+    data, client address, Private-Token header)``.
+    """
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubGitlabHandler)
+        self.responses = []
+        self.requests = []
+        self.connections = []
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def process_request(self, request, client_address):
+        # Like ThreadingMixIn, but keeping track of the connections (which
+        # are kept alive) and their threads so they can be closed
+        thread = threading.Thread(target=self.process_request_thread,
+                                  args=(request, client_address))
+        thread.daemon = True
+        self.connections.append((request, thread))
+        thread.start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        for request, thread in self.connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join()
+
+    def respond(self, status, headers=None, body=None):
+        self.responses.append((status, headers or {}, body or {}))
+
+
+class StubGitlabHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length).decode('utf-8')
+        server = self.server
+        server.requests.append((self.command, self.path, parse_qs(data),
+                                self.client_address,
+                                self.headers.get('Private-Token')))
+
+        if server.responses:
+            status, headers, body = server.responses.pop(0)
+        else:
+            status, headers, body = 201, {}, {}
+
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_POST = do_PUT = do_GET = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def gitlab():
+    server = StubGitlab()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    yield server
+
+    server.close()
+
+
+@pytest.fixture
+def client(gitlab):
+    return GitlabClient(gitlab.url, 'secret')
+
+
+def test_post_note(gitlab, client):
+    client.post_note(12, 34, u'Hello')
+    assert gitlab.requests == [
+        ('POST', '/api/v4/projects/12/merge_requests/34/notes',
+         {'body': ['Hello']}, gitlab.requests[0][3], 'secret')
+    ]
+
+
+def test_connections_are_kept_alive(gitlab, client):
+    for _ in range(3):
+        client.post_note(1, 2, u'x')
+
+    assert len(set(r[3] for r in gitlab.requests)) == 1
+
+
+def test_errors(gitlab, client):
+    gitlab.respond(500)
+    gitlab.respond(404, body={'message': '404 Not found'})
+
+    with pytest.raises(GitlabApiError) as exc:
+        client.post_note(1, 2, u'x')
+    assert exc.value.status == 500
+    assert exc.value.retryable
+
+    with pytest.raises(GitlabApiError) as exc:
+        client.close_merge_request(1, 2)
+    assert exc.value.status == 404
+    assert not exc.value.retryable
+    assert '404 Not found' in str(exc.value)
+
+
+def test_connection_errors_are_retryable():
+    client = GitlabClient('http://127.0.0.1:1', 'secret', timeout=2)
+    with pytest.raises(GitlabApiError) as exc:
+        client.post_note(1, 2, u'x')
+    assert exc.value.status is None
+    assert exc.value.retryable
+
+
+def test_retry_after(gitlab, client):
+    gitlab.respond(429, {'Retry-After': 1})
+
+    with pytest.raises(GitlabApiError) as exc:
+        client.post_note(1, 2, u'x')
+    assert exc.value.status == 429
+    assert exc.value.retry_after == 1
+    assert exc.value.retryable
+
+    # The next request waits until the limit resets
+    start = time.time()
+    client.post_note(1, 2, u'x')
+    assert time.time() - start >= 0.9
+    assert len(gitlab.requests) == 2
+
+
+def test_rate_limit_remaining(gitlab, client):
+    gitlab.respond(201, {'RateLimit-Remaining': 0,
+                         'RateLimit-Reset': int(time.time()) + 2})
+
+    client.post_note(1, 2, u'x')
+    start = time.time()
+    client.post_note(1, 2, u'x')
+    assert time.time() - start >= 0.9
+    assert len(gitlab.requests) == 2
+
+
+def test_rate_limit_fails_fast(gitlab, client):
+    gitlab.respond(429, {'RateLimit-Reset': int(time.time()) + 60})
+
+    with pytest.raises(GitlabApiError):
+        client.post_note(1, 2, u'x')
+
+    # Further requests fail without being made rather than waiting a minute
+    start = time.time()
+    with pytest.raises(GitlabApiError) as exc:
+        client.post_note(1, 2, u'x')
+    assert time.time() - start < 1
+    assert exc.value.status == 429
+    assert 55 <= exc.value.retry_after <= 61
+    assert exc.value.retryable
+    assert len(gitlab.requests) == 1
+
+
+# The outbox
+
+@pytest.fixture
+def webhook(gitlab, tmpdir):
+    from trac.db.api import DatabaseManager
+    from trac.test import EnvironmentStub
+    from sage_trac.gitlab import GitlabWebhook
+
+    git_dir = tmpdir.join('repo.git')
+    pygit2.init_repository(str(git_dir), bare=True)
+
+    env = EnvironmentStub(enable=['sage_trac.gitlab.GitlabWebhook'],
+                          path=str(tmpdir.join('env')))
+    env.config.set('sage_trac', 'repository_dir', str(git_dir))
+    env.config.set('sage_trac', 'cgit_host', 'localhost')
+    env.config.set('sage_trac', 'gitlab_url', gitlab.url)
+    env.config.set('sage_trac', 'gitlab_api_token', 'secret')
+
+    webhook = GitlabWebhook(env)
+    webhook.environment_created()
+
+    yield webhook
+
+    DatabaseManager(env).drop_tables(webhook._schema)
+    env.reset_db()
+
+
+def _outbox(webhook):
+    return webhook.env.db_query("""
+        SELECT action, body, attempts, next_attempt, worker
+        FROM gitlab_outbox ORDER BY id""")
+
+
+def _send(webhook):
+    for proj_mr_id in webhook._claim_outbox(10):
+        webhook._send_outbox(proj_mr_id)
+
+
+def test_outbox_batches_comments(gitlab, webhook):
+    webhook._queue_api_call(1, 2, 'note', u'one')
+    webhook._queue_api_call(1, 2, 'note', u'two')
+    webhook._queue_api_call(1, 3, 'note', u'other')
+    webhook._queue_api_call(1, 2, 'close', u'closing')
+    webhook._queue_api_call(1, 2, 'note', u'three')
+    webhook._queue_api_call(1, 2, 'note', u'four')
+
+    _send(webhook)
+
+    # Successive comments are combined, but not across closing the merge
+    # request, and calls for each merge request are sent in order
+    assert [(r[0], r[1], r[2]) for r in gitlab.requests] == [
+        ('POST', '/api/v4/projects/1/merge_requests/2/notes',
+         {'body': ['one\n\ntwo']}),
+        ('PUT', '/api/v4/projects/1/merge_requests/2',
+         {'state_event': ['close']}),
+        ('POST', '/api/v4/projects/1/merge_requests/2/notes',
+         {'body': ['closing']}),
+        ('POST', '/api/v4/projects/1/merge_requests/2/notes',
+         {'body': ['three\n\nfour']}),
+        ('POST', '/api/v4/projects/1/merge_requests/3/notes',
+         {'body': ['other']})
+    ]
+    assert _outbox(webhook) == []
+
+
+def test_outbox_retries(gitlab, webhook):
+    webhook._queue_api_call(1, 2, 'note', u'one')
+    webhook._queue_api_call(1, 2, 'note', u'two')
+    gitlab.respond(502)
+
+    start = int(time.time())
+    _send(webhook)
+
+    outbox = _outbox(webhook)
+    assert [row[:3] for row in outbox] == [('note', u'one', 1),
+                                           ('note', u'two', 1)]
+    # Retried after the retry delay, and released by this worker
+    assert all(row[3] >= start + webhook.retry_delay for row in outbox)
+    assert all(row[4] is None for row in outbox)
+
+    # Not ready to be sent yet
+    assert webhook._claim_outbox(10) == []
+
+    with webhook.env.db_transaction as db:
+        db("UPDATE gitlab_outbox SET next_attempt=0")
+    _send(webhook)
+
+    assert [r[2] for r in gitlab.requests] == [{'body': ['one\n\ntwo']}] * 2
+    assert _outbox(webhook) == []
+
+
+def test_outbox_retries_use_retry_after(gitlab, webhook):
+    webhook.config.set('sage_trac', 'gitlab_webhook_retry_delay', '1')
+    webhook._queue_api_call(1, 2, 'note', u'one')
+    gitlab.respond(429, {'Retry-After': 300})
+
+    start = int(time.time())
+    _send(webhook)
+
+    assert _outbox(webhook)[0][3] >= start + 300
+
+
+def test_outbox_gives_up(gitlab, webhook):
+    webhook.config.set('sage_trac', 'gitlab_webhook_max_attempts', '2')
+    webhook._queue_api_call(1, 2, 'note', u'retried')
+    webhook._queue_api_call(1, 3, 'note', u'dropped')
+    gitlab.respond(500)
+    gitlab.respond(404)
+
+    _send(webhook)
+    # The retryable failure is retried, the other one dropped
+    assert [row[1:3] for row in _outbox(webhook)] == [(u'retried', 1)]
+
+    with webhook.env.db_transaction as db:
+        db("UPDATE gitlab_outbox SET next_attempt=0")
+    gitlab.respond(500)
+    _send(webhook)
+
+    # Out of attempts
+    assert _outbox(webhook) == []
+    assert len(gitlab.requests) == 3
+
+
+def test_outbox_close_is_not_repeated(gitlab, webhook):
+    webhook._queue_api_call(1, 2, 'close', u'closing')
+    gitlab.respond(200)
+    gitlab.respond(502)
+
+    _send(webhook)
+    assert [row[:3] for row in _outbox(webhook)] == [('note', u'closing', 1)]
+
+    with webhook.env.db_transaction as db:
+        db("UPDATE gitlab_outbox SET next_attempt=0")
+    _send(webhook)
+
+    assert [(r[0], r[2]) for r in gitlab.requests] == [
+        ('PUT', {'state_event': ['close']}),
+        ('POST', {'body': ['closing']}),
+        ('POST', {'body': ['closing']})
+    ]
+    assert _outbox(webhook) == []